@@ -0,0 +1,366 @@
+"""asyncio transport for the HTTP requests of check_retrievability.py.
+
+   All dataselect, station, WFCatalog and routing requests are run on a
+   single event loop in a background thread, with pooled keep-alive
+   connections, a semaphore per host and streamed response bodies. The
+   requests of the client can also be started ahead as coroutines, so many
+   of them are in flight while the probing threads only parse and evaluate
+   the answers that already arrived.
+
+   aiohttp is only needed for this transport and imported on demand.
+"""
+
+import io
+import json
+import asyncio
+import threading
+from urllib.parse import urlparse
+from obspy import read
+from obspy import read_inventory
+from obspy import UTCDateTime
+from obspy.clients.fdsn.header import FDSNNoDataException
+from obspy.clients.fdsn.header import URL_MAPPINGS
+from mseed_headers import HeaderReader
+from routing import parse_routes
+from routing import route_url
+
+try:
+  import aiohttp
+except ImportError:
+  aiohttp = None
+
+def parse_mseed(content):
+  # Top level, so it can be run in a process pool
+  return read(io.BytesIO(content), format='MSEED')
+
+class Response(object):
+  """The part of the requests.Response interface used by the scripts."""
+
+  def __init__(self, transport, status_code, content=None, body=None, records=None, nbytes=0):
+    self.transport = transport
+    self.status_code = status_code
+    self._content = content
+    # Unread streamed body, together with the host slot it occupies
+    self.body = body
+    # Headers of the miniSEED records, if only they were kept
+    self.records = records
+    self.nbytes = nbytes if content is None else len(content)
+
+  @property
+  def content(self):
+    if self._content is None:
+      self._content = b''.join(self.iter_content())
+    return self._content
+
+  def json(self):
+    return json.loads(self.content.decode('utf-8'))
+
+  def iter_content(self, chunk_size=64*1024):
+    # Every chunk is read on the event loop as it is asked for, so a slow
+    # consumer holds back the connection instead of buffering the body
+    if self.body is None:
+      if self._content:
+        yield self._content
+      return
+    try:
+      while True:
+        chunk = self.transport.run(self.body[0].content.read(chunk_size))
+        if not chunk:
+          break
+        yield chunk
+    finally:
+      self.close()
+
+  def close(self):
+    if self.body is not None:
+      body, self.body = self.body, None
+      self.transport.run(self.transport.release(*body))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+class AsyncSession(object):
+  """Blocking requests-like session, running its requests on the event loop."""
+
+  def __init__(self, transport):
+    self.transport = transport
+
+  def get(self, url, params=None, timeout=None, stream=False):
+    return self.transport.request('GET', url, params=params, timeout=timeout, stream=stream)
+
+  def post(self, url, data=None, timeout=None, stream=False):
+    return self.transport.request('POST', url, data=data, timeout=timeout, stream=stream)
+
+class AsyncTransport(object):
+  """Event loop in a background thread that performs all HTTP requests."""
+
+  def __init__(self, limit=100, per_host=8):
+    if aiohttp is None:
+      raise ImportError('The async transport needs aiohttp, install it with "pip install aiohttp".')
+    self.per_host = per_host
+    self.semaphores = {}
+    self.loop = asyncio.new_event_loop()
+    self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+    self.thread.start()
+    self.session = self.run(self.open(limit))
+    self.sessions = AsyncSession(self)
+
+  async def open(self, limit):
+    connector = aiohttp.TCPConnector(limit=limit, keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector)
+
+  def run(self, coroutine):
+    return self.submit(coroutine).result()
+
+  def submit(self, coroutine):
+    # Start the coroutine without waiting for it
+    return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+  def get(self, url):
+    # Same interface as SessionPool, every endpoint shares the event loop
+    return self.sessions
+
+  def semaphore(self, netloc):
+    # Only used on the event loop, so no lock is needed
+    if netloc not in self.semaphores:
+      self.semaphores[netloc] = asyncio.Semaphore(self.per_host)
+    return self.semaphores[netloc]
+
+  async def open_request(self, method, url, params, data, timeout):
+    # The response with its body still unread
+    return await self.session.request(
+      method, url, data=data,
+      params=dict((k, str(v)) for k, v in params.items()) if params else None,
+      timeout=aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout))
+
+  async def fetch(self, method, url, params, data, timeout, stream):
+    semaphore = self.semaphore(urlparse(url).netloc)
+    await semaphore.acquire()
+    try:
+      response = await self.open_request(method, url, params, data, timeout)
+    except BaseException:
+      semaphore.release()
+      raise
+    if stream:
+      # The host slot is held until the body was read or the response closed
+      return response.status, None, (response, semaphore)
+    try:
+      return response.status, await response.read(), None
+    finally:
+      await self.release(response, semaphore)
+
+  async def release(self, response, semaphore):
+    response.release()
+    semaphore.release()
+
+  def request(self, method, url, params=None, data=None, timeout=None, stream=False):
+    status, content, body = self.run(self.fetch(method, url, params, data, timeout, stream))
+    return Response(self, status, content, body)
+
+  def close(self):
+    self.run(self.session.close())
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()
+
+def query_value(value):
+  if isinstance(value, UTCDateTime):
+    return value.format_iris_web_service()
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  return value
+
+def request_key(params):
+  return tuple(sorted((k, str(v)) for k, v in params.items()))
+
+class TransportClient(object):
+  """Station and dataselect client with the obspy client interface used by
+     check_retrievability.py, running its requests on the async transport.
+     With a node health, every request is recorded in it like the requests
+     of the obspy clients are by TrackedClient."""
+
+  def __init__(self, transport, node=None, routing_url=None, timeout=30, parse_pool=None,
+               health=None):
+    self.transport = transport
+    # With a node, all requests go to its services, otherwise to the data
+    # centers given by the routing service
+    self.base_url = URL_MAPPINGS.get(node.upper(), node) if node is not None else None
+    self.routing_url = routing_url
+    self.timeout = timeout
+    # Optional process pool to decode the miniSEED data in
+    self.parse_pool = parse_pool
+    self.health = health
+    # Key of the data center of a URL in the node health
+    self.datacenter = lambda url: urlparse(url).netloc
+    self.lock = threading.Lock()
+    self.cache = {}
+    # Requests started ahead, until their answers are asked for
+    self.pending = {}
+
+  async def request(self, service, method, url, params=None, data=None, records=False):
+    # The host slot is taken first, so the time spent waiting for it is not
+    # counted as latency of the data center
+    async with self.transport.semaphore(urlparse(url).netloc):
+      if self.health is None:
+        return await self.send(service, method, url, params, data, records, self.timeout)
+      dc = self.datacenter(url)
+      r = await self.health.call_async(
+        dc, service, lambda timeout: self.send(service, method, url, params, data, records, timeout))
+      self.health.metrics.received(dc, service, r.nbytes)
+      return r
+
+  async def send(self, service, method, url, params, data, records, timeout):
+    response = await self.transport.open_request(method, url, params, data, timeout)
+    try:
+      if response.status not in (200, 204, 404):
+        # Keeps the status, so refused bulk requests can be told apart
+        response.raise_for_status()
+        raise Exception('%s request to %s failed with status %d'
+                        % (service.capitalize(), url, response.status))
+      if not records:
+        return Response(self.transport, response.status, await response.read())
+      # Only the headers of the miniSEED records are kept while the data arrives
+      reader = HeaderReader()
+      nbytes = 0
+      while True:
+        chunk = await response.content.read(64*1024)
+        if not chunk:
+          break
+        nbytes += len(chunk)
+        reader.feed(chunk)
+      return Response(self.transport, response.status, records=reader.records, nbytes=nbytes)
+    finally:
+      response.release()
+
+  async def routes(self, service, params):
+    # List of (url, streams) of the data centers serving the selection, with
+    # the streams as in routing.parse_routes()
+    key = (service, params.get('network'))
+    if self.base_url is not None:
+      return [(self.base_url + '/fdsnws/%s/1/query' % service, None)]
+    if key[1] is None:
+      return await self.lookup(service, params)
+    # Only used on the event loop; requests sent at the same time share the
+    # lookup in flight
+    if key not in self.cache:
+      self.cache[key] = asyncio.ensure_future(self.lookup(service, params))
+    try:
+      return await asyncio.shield(self.cache[key])
+    except Exception:
+      # Failed lookups are tried again by the next request
+      self.cache.pop(key, None)
+      raise
+
+  async def lookup(self, service, params):
+    query = dict(service=service, format='post')
+    for name in ('network', 'station', 'channel'):
+      if params.get(name) is not None:
+        query[name] = params[name]
+    r = await self.request('routing', 'GET', self.routing_url, params=query)
+    if r.status_code != 200:
+      raise FDSNNoDataException('No routing information for %s: %s' % (service, query))
+    return parse_routes(r.content.decode('utf-8'))
+
+  def start(self, key, coroutine):
+    # Send a request ahead, its answer is kept until it is asked for
+    future = self.transport.submit(coroutine)
+    with self.lock:
+      self.pending[key] = future
+    return key
+
+  def result(self, key, coroutine_function):
+    # The answer of a request started ahead, otherwise the request is sent now
+    with self.lock:
+      future = self.pending.pop(key, None)
+    if future is None:
+      return self.transport.run(coroutine_function())
+    return future.result()
+
+  def forget(self, keys):
+    # Drop the answers of requests started ahead that were never asked for
+    with self.lock:
+      futures = [self.pending.pop(key) for key in keys if key in self.pending]
+    for future in futures:
+      future.cancel()
+
+  def station_params(self, kwargs):
+    return dict((k, query_value(v)) for k, v in kwargs.items() if v is not None)
+
+  async def fetch_stations(self, params):
+    queries = []
+    for url, streams in await self.routes('station', params):
+      query = dict(params)
+      if 'network' not in query and streams:
+        query['network'] = ','.join(sorted(set(stream[0] for stream in streams)))
+      queries.append(self.request('station', 'GET', url, params=query))
+    return [r.content for r in await asyncio.gather(*queries) if r.status_code == 200]
+
+  def prefetch_stations(self, **kwargs):
+    params = self.station_params(kwargs)
+    return self.start(('station', request_key(params)), self.fetch_stations(params))
+
+  def get_stations(self, **kwargs):
+    params = self.station_params(kwargs)
+    inventory = None
+    for content in self.result(('station', request_key(params)),
+                               lambda: self.fetch_stations(params)):
+      part = read_inventory(io.BytesIO(content), format='STATIONXML')
+      if inventory is None:
+        inventory = part
+      else:
+        inventory += part
+    if inventory is None:
+      raise FDSNNoDataException('No data available for request.')
+    return inventory
+
+  def get_waveforms(self, network, station, location, channel, starttime, endtime):
+    return self.get_waveforms_bulk([(network, station, location, channel, starttime, endtime)])
+
+  def bulk_lines(self, bulk):
+    return tuple('%s %s %s %s %s %s' % (net, sta, loc if loc else '--', cha,
+                                        query_value(start), query_value(end))
+                 for net, sta, loc, cha, start, end in bulk)
+
+  async def fetch_waveforms(self, bulk):
+    # One POST request per data center, with the lines of the streams it
+    # serves at their start times
+    lines = {}
+    for net, sta, loc, cha, start, end in bulk:
+      url = route_url(await self.routes('dataselect', {'network': net}),
+                      net, sta, cha, UTCDateTime(start))
+      if url is not None:
+        lines.setdefault(url, []).extend(self.bulk_lines([(net, sta, loc, cha, start, end)]))
+    answers = await asyncio.gather(*[self.request('dataselect', 'POST', url, data='\n'.join(body))
+                                     for url, body in lines.items()])
+    return [r.content for r in answers if r.status_code == 200]
+
+  def prefetch_waveforms_bulk(self, bulk):
+    return self.start(('dataselect', self.bulk_lines(bulk)), self.fetch_waveforms(bulk))
+
+  def get_waveforms_bulk(self, bulk):
+    stream = None
+    for content in self.result(('dataselect', self.bulk_lines(bulk)),
+                               lambda: self.fetch_waveforms(bulk)):
+      if self.parse_pool is not None:
+        part = self.parse_pool.submit(parse_mseed, content).result()
+      else:
+        part = parse_mseed(content)
+      if stream is None:
+        stream = part
+      else:
+        stream += part
+    if stream is None:
+      raise FDSNNoDataException('No data available for request.')
+    return stream
+
+  async def fetch_records(self, url, body):
+    return (await self.request('dataselect', 'POST', url, data=body, records=True)).records
+
+  def prefetch_records(self, url, body):
+    return self.start(('records', url, body), self.fetch_records(url, body))
+
+  def get_records(self, url, body):
+    # Header mode: the headers of the miniSEED records of a POST request
+    return self.result(('records', url, body), lambda: self.fetch_records(url, body))
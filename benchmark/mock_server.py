@@ -0,0 +1,293 @@
+"""Local stand-in for the FDSN station and dataselect services, the EIDA
+   routing service and the WFCatalog, serving synthetic data.
+
+   It is meant for benchmarking the scripts of this repository without
+   touching the production EIDA nodes.
+"""
+
+import io
+import json
+import time
+import random
+import zlib
+import argparse
+import fnmatch
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from obspy import UTCDateTime, Trace, Stream
+from obspy.core.inventory import Inventory, Network, Station, Channel, Site
+from obspy.core.inventory.response import Response
+
+WADL = '''<?xml version="1.0" encoding="UTF-8"?>
+<application xmlns="http://wadl.dev.java.net/2009/02" xmlns:xs="http://www.w3.org/2001/XMLSchema">
+ <resources base="%s">
+  <resource path="query">
+   <method name="GET">
+    <request>
+%s
+    </request>
+   </method>
+  </resource>
+ </resources>
+</application>
+'''
+
+WADL_PARAMETERS = {
+  'dataselect': [('starttime', 'xs:dateTime'), ('endtime', 'xs:dateTime'), ('network', 'xs:string'),
+                 ('station', 'xs:string'), ('location', 'xs:string'), ('channel', 'xs:string'),
+                 ('quality', 'xs:string'), ('minimumlength', 'xs:double'),
+                 ('longestonly', 'xs:boolean')],
+  'station': [('starttime', 'xs:dateTime'), ('endtime', 'xs:dateTime'), ('startbefore', 'xs:dateTime'),
+              ('startafter', 'xs:dateTime'), ('endbefore', 'xs:dateTime'), ('endafter', 'xs:dateTime'),
+              ('network', 'xs:string'), ('station', 'xs:string'), ('location', 'xs:string'),
+              ('channel', 'xs:string'), ('minlatitude', 'xs:double'), ('maxlatitude', 'xs:double'),
+              ('minlongitude', 'xs:double'), ('maxlongitude', 'xs:double'), ('latitude', 'xs:double'),
+              ('longitude', 'xs:double'), ('minradius', 'xs:double'), ('maxradius', 'xs:double'),
+              ('level', 'xs:string'), ('includerestricted', 'xs:boolean'),
+              ('includeavailability', 'xs:boolean'), ('updatedafter', 'xs:dateTime'),
+              ('matchtimeseries', 'xs:boolean'), ('format', 'xs:string')],
+}
+
+class MockData(object):
+  """Synthetic inventory, waveforms and metrics of the mock server."""
+
+  def __init__(self, networks, stations, locations, sampling_rate, gap_rate, seed):
+    self.sampling_rate = sampling_rate
+    self.gap_rate = gap_rate
+    self.seed = seed
+    rng = random.Random(seed)
+    self.codes = []
+    inventories = {'station': [], 'channel': [], 'response': []}
+    start = UTCDateTime(2000, 1, 1)
+    for n in range(networks):
+      net = chr(ord('A') + n // 26) + chr(ord('A') + n % 26)
+      nets = {level: Network(code=net) for level in inventories}
+      for s in range(stations):
+        sta = 'S%03d' % s
+        lat, lon = rng.uniform(35.0, 70.0), rng.uniform(-10.0, 40.0)
+        for level, network in nets.items():
+          station = Station(code=sta, latitude=lat, longitude=lon, elevation=100.0,
+                            start_date=start, site=Site(name=sta))
+          if level != 'station':
+            for l in range(locations):
+              loc = '%02d' % (l * 10)
+              channel = Channel(code='HHZ', location_code=loc, latitude=lat, longitude=lon,
+                                elevation=100.0, depth=0.0, azimuth=0.0, dip=-90.0,
+                                sample_rate=sampling_rate, start_date=start)
+              if level == 'response':
+                channel.response = Response.from_paz(
+                  zeros=[0j, 0j], poles=[-0.037+0.037j, -0.037-0.037j],
+                  stage_gain=1500.0, input_units='M/S', output_units='V')
+              station.channels.append(channel)
+          network.stations.append(station)
+        for l in range(locations):
+          self.codes.append((net, sta, '%02d' % (l * 10), 'HHZ'))
+      for level, network in nets.items():
+        inventories[level].append(network)
+    self.inventories = {level: Inventory(networks=networks, source='mock')
+                        for level, networks in inventories.items()}
+
+  def stations(self, params):
+    level = params.get('level', 'station')
+    inventory = self.inventories['response' if level == 'response' else
+                                 'channel' if level == 'channel' else 'station']
+    if 'updatedafter' in params:
+      # Nothing ever changes in the mock inventory
+      return None
+    selected = Inventory(networks=[], source='mock')
+    for network in inventory:
+      if not matches(network.code, params.get('network', '*')):
+        continue
+      stations = []
+      for station in network:
+        if not matches(station.code, params.get('station', '*')):
+          continue
+        if level in ('channel', 'response'):
+          channels = [c for c in station if matches(c.code, params.get('channel', '*'))]
+          if len(channels) == 0:
+            continue
+          station = station.copy()
+          station.channels = channels
+        stations.append(station)
+      if len(stations) > 0:
+        selected.networks.append(Network(code=network.code, stations=stations))
+    if len(selected.networks) == 0:
+      return None
+    buf = io.BytesIO()
+    selected.write(buf, format='STATIONXML')
+    return buf.getvalue()
+
+  def window_rng(self, *key):
+    return random.Random(zlib.crc32(('%s %s' % (self.seed, key)).encode('utf-8')))
+
+  def waveforms(self, requests):
+    stream = Stream()
+    for net, sta, loc, cha, start, end in requests:
+      for code in self.codes:
+        if not all(matches(c, p) for c, p in zip(code, (net, sta, loc, cha))):
+          continue
+        rng = self.window_rng(code, str(start))
+        # Gaps cut away the second half of the window
+        length = end - start
+        if rng.random() < self.gap_rate:
+          length = length / 2.0
+        npts = int(length * self.sampling_rate)
+        if npts <= 0:
+          continue
+        data = np.random.RandomState(rng.randint(0, 2**31)).randint(-1000, 1000, npts).astype(np.int32)
+        stream.append(Trace(data=data, header={'network': code[0], 'station': code[1],
+                                              'location': code[2], 'channel': code[3],
+                                              'starttime': start,
+                                              'sampling_rate': self.sampling_rate}))
+    if len(stream) == 0:
+      return None
+    buf = io.BytesIO()
+    stream.write(buf, format='MSEED', reclen=512, encoding='STEIM2')
+    return buf.getvalue()
+
+  def metrics(self, params):
+    start = UTCDateTime(params['start'])
+    end = UTCDateTime(params['end'])
+    docs = []
+    day = UTCDateTime(start.date)
+    while day < end:
+      for code in self.codes:
+        if not all(matches(c, params.get(key, '*')) for c, key in
+                   zip(code, ('network', 'station', 'location', 'channel'))):
+          continue
+        if self.window_rng(code, day.date).random() < self.gap_rate:
+          continue
+        docs.append({'network': code[0], 'station': code[1], 'location': code[2],
+                     'channel': code[3], 'start_time': day.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                     'end_time': (day + 86400).strftime('%Y-%m-%dT%H:%M:%S.000Z')})
+      day += 86400
+    if len(docs) == 0:
+      return None
+    return json.dumps(docs).encode('utf-8')
+
+def matches(code, patterns):
+  return any(fnmatch.fnmatch(code, pattern) for pattern in patterns.split(','))
+
+class MockHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def send(self, status, body=None, content_type='text/plain'):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body) if body else 0))
+    self.end_headers()
+    if body:
+      self.wfile.write(body)
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+    self.handle_request(url.path, params, None)
+
+  def do_POST(self):
+    url = urlparse(self.path)
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+    self.handle_request(url.path, {}, body)
+
+  def handle_request(self, path, params, body):
+    server = self.server
+    with server.lock:
+      server.counts['requests'] += 1
+    if path == '/stats':
+      with server.lock:
+        return self.send(200, json.dumps(server.counts).encode('utf-8'), 'application/json')
+    time.sleep(server.latency)
+    if path.endswith('application.wadl'):
+      service = path.split('/')[2]
+      if service not in WADL_PARAMETERS:
+        return self.send(404)
+      parameters = '\n'.join('     <param name="%s" style="query" type="%s"/>' % p
+                             for p in WADL_PARAMETERS[service])
+      # obspy tells the services apart by their base URL
+      base = '%s/fdsnws/%s/1' % (self.server.url, service)
+      return self.send(200, (WADL % (base, parameters)).encode('utf-8'), 'application/xml')
+    if server.error_rate > 0 and random.random() < server.error_rate and not path.endswith('/version'):
+      return self.send(503, b'Service temporarily unavailable')
+    if path == '/fdsnws/station/1/query':
+      result = server.data.stations(params)
+      return self.send(200, result, 'application/xml') if result else self.send(204)
+    elif path == '/fdsnws/dataselect/1/query':
+      if body is not None:
+        requests = []
+        for line in body.splitlines():
+          parts = line.split()
+          if len(parts) == 6:
+            net, sta, loc, cha, start, end = parts
+            requests.append((net, sta, '' if loc == '--' else loc, cha,
+                             UTCDateTime(start), UTCDateTime(end)))
+      else:
+        requests = [(params.get('network', '*'), params.get('station', '*'),
+                     params.get('location', '*'), params.get('channel', '*'),
+                     UTCDateTime(params['starttime']), UTCDateTime(params['endtime']))]
+      result = server.data.waveforms(requests)
+      return self.send(200, result, 'application/vnd.fdsn.mseed') if result else self.send(204)
+    elif path == '/eidaws/routing/1/query':
+      service = params.get('service', 'dataselect')
+      if service == 'wfcatalog':
+        target = server.url + '/eidaws/wfcatalog/1/query'
+      else:
+        target = server.url + '/fdsnws/%s/1/query' % service
+      lines = '%s\n%s %s * %s 1900-01-01T00:00:00 2100-01-01T00:00:00\n' % (
+        target, params.get('network', '*'), params.get('station', '*'), params.get('channel', '*'))
+      return self.send(200, lines.encode('utf-8'))
+    elif path == '/eidaws/wfcatalog/1/query':
+      result = server.data.metrics(params)
+      return self.send(200, result, 'application/json') if result else self.send(204)
+    elif path.endswith('/version'):
+      return self.send(200, b'1.1.0')
+    return self.send(404)
+
+def make_server(port, data, latency=0.0, error_rate=0.0):
+  server = ThreadingHTTPServer(('127.0.0.1', port), MockHandler)
+  server.daemon_threads = True
+  server.data = data
+  server.latency = latency
+  server.error_rate = error_rate
+  server.lock = threading.Lock()
+  server.counts = {'requests': 0}
+  server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+  return server
+
+def main():
+  desc = 'Local mock of the FDSN, EIDA routing and WFCatalog services with synthetic data.'
+  parser = argparse.ArgumentParser(description=desc)
+  parser.add_argument('-p', '--port', default=8080, type=int,
+                      help='Port to listen on (default=8080).')
+  parser.add_argument('--networks', default=2, type=int,
+                      help='Number of synthetic networks (default=2).')
+  parser.add_argument('--stations', default=5, type=int,
+                      help='Number of stations per network (default=5).')
+  parser.add_argument('--locations', default=1, type=int,
+                      help='Number of location codes per station (default=1).')
+  parser.add_argument('--sampling_rate', default=100.0, type=float,
+                      help='Sampling rate of the synthetic waveforms (default=100).')
+  parser.add_argument('--latency', default=0.0, type=float,
+                      help='Seconds to wait before answering each request (default=0).')
+  parser.add_argument('--error_rate', default=0.0, type=float,
+                      help='Fraction of requests answered with an error (default=0).')
+  parser.add_argument('--gap_rate', default=0.1, type=float,
+                      help='Fraction of windows and days with gaps in the data (default=0.1).')
+  parser.add_argument('--seed', default=0, type=int,
+                      help='Seed for the synthetic data (default=0).')
+  args = parser.parse_args()
+  data = MockData(args.networks, args.stations, args.locations, args.sampling_rate,
+                  args.gap_rate, args.seed)
+  server = make_server(args.port, data, args.latency, args.error_rate)
+  print('Serving %d channels at %s' % (len(data.codes), server.url), flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,116 @@
+"""Offline benchmark of check_retrievability.py and make_coordinate_list.py.
+
+   Both scripts are run against the local mock server at several network
+   sizes, reporting channels per minute, requests per second and peak RSS.
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import datetime
+import tempfile
+import subprocess
+import requests
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+def start_server(args, networks, stations):
+  cmd = [sys.executable, os.path.join(BENCHMARK_DIR, 'mock_server.py'), '--port', '0',
+         '--networks', str(networks), '--stations', str(stations),
+         '--locations', str(args.locations), '--latency', str(args.latency),
+         '--error_rate', str(args.error_rate), '--gap_rate', str(args.gap_rate)]
+  server = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+  # The server announces its address once it is ready
+  line = server.stdout.readline()
+  if not line:
+    raise Exception('Mock server failed to start')
+  return server, line.split()[-1]
+
+def request_count(url):
+  return requests.get(url + '/stats').json()['requests']
+
+def run(cmd, cwd, url):
+  before = request_count(url)
+  start = time.time()
+  process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL)
+  _, status, usage = os.wait4(process.pid, 0)
+  process.returncode = os.waitstatus_to_exitcode(status)
+  seconds = time.time() - start
+  # The stats request itself is not counted
+  requests_made = request_count(url) - before - 1
+  if process.returncode != 0:
+    raise Exception('%s failed with exit code %d' % (cmd[1], process.returncode))
+  return {'seconds': seconds,
+          'requests': requests_made,
+          'requests_per_second': requests_made / seconds,
+          'peak_rss_mb': usage.ru_maxrss / 1024.0}
+
+def count_channels(filename):
+  # Number of channels with a result and the number of windows probed
+  with open(filename) as infile:
+    results = json.load(infile)
+  channels = 0
+  windows = 0
+  for node in results.values():
+    for year in node.values():
+      for net in year.values():
+        for sta in net.values():
+          channels += sum(1 for result in sta.values() if result)
+          windows += sum(result.get('windows', 0) for result in sta.values())
+  return channels, windows
+
+def main():
+  year = datetime.datetime.now().year - 1
+  desc = 'Benchmark the scripts against a local mock of the EIDA services.'
+  parser = argparse.ArgumentParser(description=desc)
+  parser.add_argument('--sizes', default='1x5,2x10,4x25', type=str,
+                      help='Comma-separated network sizes as networks x stations (default=1x5,2x10,4x25).')
+  parser.add_argument('--locations', default=1, type=int,
+                      help='Number of location codes per station (default=1).')
+  parser.add_argument('--latency', default=0.01, type=float,
+                      help='Latency of the mock server in seconds (default=0.01).')
+  parser.add_argument('--error_rate', default=0.0, type=float,
+                      help='Fraction of requests answered with an error (default=0).')
+  parser.add_argument('--gap_rate', default=0.1, type=float,
+                      help='Fraction of windows and days with gaps in the data (default=0.1).')
+  parser.add_argument('--check_args', default='--days 5 --hours 2', type=str,
+                      help='Additional arguments for check_retrievability.py (default="--days 5 --hours 2").')
+  parser.add_argument('-o', '--output_filename', default=None, type=str,
+                      help='JSON file to write the benchmark results to (default=None).')
+  args = parser.parse_args()
+  report = []
+  for size in args.sizes.split(','):
+    networks, stations = map(int, size.split('x'))
+    server, url = start_server(args, networks, stations)
+    try:
+      with tempfile.TemporaryDirectory() as workdir:
+        common = ['--nodes', url, '-s', str(year), '-e', str(year), '-a', os.path.join(workdir, 'token')]
+        check = run([sys.executable, os.path.join(REPO_DIR, 'check_retrievability.py')] + common
+                    + ['--routing_url', url + '/eidaws/routing/1/query', '--seed', '0',
+                       '-o', os.path.join(workdir, 'results.json')]
+                    + shlex.split(args.check_args), workdir, url)
+        check['channels'], windows = count_channels(os.path.join(workdir, 'results.json'))
+        check['channels_per_minute'] = check['channels'] / check['seconds'] * 60.0
+        check['windows_per_channel'] = windows / max(check['channels'], 1)
+        coords = run([sys.executable, os.path.join(REPO_DIR, 'make_coordinate_list.py')] + common,
+                     workdir, url)
+    finally:
+      server.terminate()
+      server.wait()
+    report.append({'size': size, 'check_retrievability': check, 'make_coordinate_list': coords})
+    print('%-8s check_retrievability: %4d channels, %5.1f windows/channel, %8.1f channels/min, '
+          '%7.1f req/s, %7.1f MB peak RSS'
+          % (size, check['channels'], check['windows_per_channel'], check['channels_per_minute'],
+             check['requests_per_second'], check['peak_rss_mb']))
+    print('%-8s make_coordinate_list: %8.2f s, %7.1f req/s, %7.1f MB peak RSS'
+          % (size, coords['seconds'], coords['requests_per_second'], coords['peak_rss_mb']))
+  if args.output_filename is not None:
+    with open(args.output_filename, 'w') as outfile:
+      json.dump(report, outfile, indent=1)
+
+if __name__ == '__main__':
+  main()
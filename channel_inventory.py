@@ -0,0 +1,105 @@
+"""Shared channel discovery of check_retrievability.py and make_coordinate_list.py.
+
+   The channel level inventory of each node is fetched once for the whole
+   time span and kept as a flat list of channel epochs, which can be written
+   to disk and reused by both scripts. An in-memory index of the epochs
+   slices out the channels open in any part of the span, e.g. one year.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import namedtuple
+import numpy as np
+from obspy import UTCDateTime
+
+# The widest channel selection of both scripts
+CHANNELS = '*HZ'
+
+Epoch = namedtuple('Epoch', ['network', 'station', 'location', 'channel', 'start_date', 'end_date',
+                             'latitude', 'longitude', 'elevation'])
+
+def flatten_inventory(inventory):
+  # One row per channel epoch, in the order of the inventory
+  rows = []
+  for net in inventory:
+    for sta in net:
+      for cha in sta:
+        rows.append([net.code, sta.code, cha.location_code, cha.code, str(cha.start_date),
+                     str(cha.end_date) if cha.end_date is not None else None,
+                     sta.latitude, sta.longitude, sta.elevation])
+  return rows
+
+class ChannelIndex(object):
+  """Channel epochs of one node, indexed by their start and end times."""
+
+  def __init__(self, rows):
+    self.rows = rows
+    starts = np.array([UTCDateTime(row[4]).timestamp for row in rows], dtype=float)
+    self.ends = np.array([UTCDateTime(row[5]).timestamp if row[5] is not None else np.inf
+                          for row in rows], dtype=float)
+    # Rows sorted by start time, so the epochs starting before the end of a
+    # slice are a prefix of them
+    self.order = np.argsort(starts, kind='stable')
+    self.starts = starts[self.order]
+
+  def select(self, starttime, endtime, channels=None):
+    # Epochs overlapping starttime..endtime, in the order of the inventory
+    count = np.searchsorted(self.starts, UTCDateTime(endtime).timestamp, side='right')
+    candidates = self.order[:count]
+    candidates = np.sort(candidates[self.ends[candidates] >= UTCDateTime(starttime).timestamp])
+    epochs = []
+    for i in candidates:
+      row = self.rows[i]
+      if channels is not None and row[3] not in channels:
+        continue
+      epochs.append(Epoch(row[0], row[1], row[2], row[3], UTCDateTime(row[4]),
+                          UTCDateTime(row[5]) if row[5] is not None else None,
+                          row[6], row[7], row[8]))
+    return epochs
+
+  def stations(self):
+    # Coordinates of all stations, in the order of the inventory
+    seen = {}
+    for row in self.rows:
+      if (row[0], row[1]) not in seen:
+        seen[(row[0], row[1])] = (row[6], row[7], row[8])
+    return [(net, sta) + coords for (net, sta), coords in seen.items()]
+
+class ChannelInventory(object):
+  """Channel epochs of all nodes, optionally persisted in a JSON file."""
+
+  def __init__(self, filename=None, max_age=24):
+    self.filename = filename
+    # Maximum age of a stored inventory in hours
+    self.max_age = max_age * 3600
+    self.lock = threading.Lock()
+    self.nodes = {}
+    if filename is not None and os.path.exists(filename):
+      with open(filename) as infile:
+        self.nodes = json.load(infile)
+
+  def index(self, node, starttime, endtime, fetch):
+    # The stored inventory is reused if it covers the span and is recent
+    # enough, otherwise fetch(starttime, endtime) is asked for a new one
+    with self.lock:
+      entry = self.nodes.get(node)
+    if (entry is not None and UTCDateTime(entry['starttime']) <= UTCDateTime(starttime)
+        and UTCDateTime(entry['endtime']) >= UTCDateTime(endtime)
+        and time.time() - entry['created'] < self.max_age):
+      print('Using the stored channel inventory of %s.' % node)
+      return ChannelIndex(entry['channels'])
+    entry = {'starttime': str(UTCDateTime(starttime)), 'endtime': str(UTCDateTime(endtime)),
+             'created': time.time(), 'channels': flatten_inventory(fetch(starttime, endtime))}
+    with self.lock:
+      self.nodes[node] = entry
+    return ChannelIndex(entry['channels'])
+
+  def save(self):
+    if self.filename is None:
+      return
+    with self.lock:
+      with open(self.filename + '.tmp', 'w') as outfile:
+        json.dump(self.nodes, outfile)
+      os.replace(self.filename + '.tmp', self.filename)
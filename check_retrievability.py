@@ -6,45 +6,934 @@
 """
 
 import os
+import re
+import math
 import json
 import argparse
 import datetime
 import random
 import time
+import threading
 import requests
-import json
+import numpy
+from urllib.parse import urlparse
+from collections import deque
+from collections import namedtuple
+from statistics import NormalDist
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from obspy.clients.fdsn import Client
 from obspy.clients.fdsn import RoutingClient
+from obspy.clients.fdsn.header import FDSNException
+from obspy.clients.fdsn.header import FDSNNoDataException
+from obspy.clients.fdsn.header import FDSNBadRequestException
+from obspy.clients.fdsn.header import FDSNRequestTooLargeException
 from obspy import UTCDateTime
-from obspy import Stream
-
-def wfcatalog(net, sta, cha, start, end):
-  params = dict()
-  params['network'] = net
-  params['station'] = sta
-  params['channel'] = cha
-  # No time can be included in these parameters because the WFCatalog
-  # at BGR seems to have problems with it
-  params['start'] = '%d-%02d-%02d' % (start.year, start.month, start.day)
-  params['end'] = '%d-%02d-%02d' % (end.year, end.month, end.day)
-  params['format'] = 'post'
-  params['service'] = 'wfcatalog'
-  r = requests.get('http://www.orfeus-eu.org/eidaws/routing/1/query', params)
-  if r.status_code == 200:
+from mseed_headers import HeaderReader
+from mseed_headers import window_coverage
+from request_metrics import RequestMetrics
+from response_cache import ResponseCache
+from channel_inventory import ChannelInventory
+from channel_inventory import CHANNELS
+from sharding import parse_shard
+from sharding import shard_of
+from sharding import channel_random
+from sharding import write_manifest
+from async_transport import AsyncTransport
+from async_transport import TransportClient
+from routing import parse_routes
+from routing import route_url
+
+# Channels whose retrievability is tested
+TESTED_CHANNELS = ('BHZ', 'HHZ')
+
+class SessionPool(object):
+  """Keep-alive sessions, one per endpoint, shared by all workers."""
+
+  def __init__(self, pool_size=10):
+    self.pool_size = pool_size
+    self.lock = threading.Lock()
+    self.sessions = {}
+
+  def get(self, url):
+    netloc = urlparse(url).netloc
+    with self.lock:
+      if netloc not in self.sessions:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self.sessions[netloc] = session
+      return self.sessions[netloc]
+
+class CircuitOpen(Exception):
+  pass
+
+def error_status(e):
+  if isinstance(e, requests.Timeout) or 'timeout' in type(e).__name__.lower() \
+     or 'timed out' in str(e):
+    return 'timeout'
+  return 'error'
+
+class NodeHealth(object):
+  """Circuit breakers and latency statistics per data center and service."""
+
+  def __init__(self, metrics, failures=5, retry=300, timeout=30, min_timeout=5, adaptive=False):
+    self.metrics = metrics
+    # Number of consecutive failures after which the circuit is opened
+    self.failures = failures
+    # Seconds until an open circuit lets a single trial call through
+    self.retry = retry
+    self.max_timeout = timeout
+    self.min_timeout = min_timeout
+    self.adaptive = adaptive
+    self.lock = threading.Lock()
+    self.stats = {}
+    self.unavailable = 0
+
+  def entry(self, dc, service):
+    key = (dc, service)
+    if key not in self.stats:
+      self.stats[key] = {'latencies': deque(maxlen=200), 'calls': 0, 'failures': 0,
+                         'consecutive': 0, 'failed_time': 0.0, 'state': 'closed',
+                         'opened': 0.0, 'trial': False, 'opens': 0, 'skipped': 0,
+                         'saved': 0.0}
+    return self.stats[key]
+
+  def is_open(self, dc, service):
+    with self.lock:
+      stats = self.entry(dc, service)
+      return stats['state'] == 'open' and time.time() - stats['opened'] < self.retry
+
+  def timeout(self, dc, service):
+    # Adapt the timeout to the observed latencies of successful calls
+    with self.lock:
+      latencies = list(self.entry(dc, service)['latencies'])
+    if not self.adaptive or len(latencies) < 20:
+      return self.max_timeout
+    return min(self.max_timeout, max(self.min_timeout, 3.0 * numpy.percentile(latencies, 95)))
+
+  def call(self, dc, service, func):
+    # Run func(timeout) unless the circuit of the data center and service
+    # is open, and keep track of the outcome
+    timeout = self.begin(dc, service)
+    callstart = time.time()
+    try:
+      result = func(timeout)
+    except Exception as e:
+      self.finish(dc, service, callstart, error=e)
+      raise
+    self.finish(dc, service, callstart, result=result)
+    return result
+
+  async def call_async(self, dc, service, func):
+    # Same as call(), for a coroutine function func(timeout) run on the
+    # event loop of the async transport
+    timeout = self.begin(dc, service)
+    callstart = time.time()
+    try:
+      result = await func(timeout)
+    except Exception as e:
+      self.finish(dc, service, callstart, error=e)
+      raise
+    except BaseException:
+      # Cancelled as the answer is no longer needed, which tells nothing
+      # about the data center
+      self.abandon(dc, service)
+      raise
+    self.finish(dc, service, callstart, result=result)
+    return result
+
+  def begin(self, dc, service):
+    # Returns the timeout of the call, or raises CircuitOpen
+    with self.lock:
+      stats = self.entry(dc, service)
+      if stats['state'] == 'open':
+        if time.time() - stats['opened'] >= self.retry and not stats['trial']:
+          stats['trial'] = True
+        else:
+          stats['skipped'] += 1
+          # Every skipped call saves about as much as an average failed one
+          stats['saved'] += stats['failed_time'] / max(stats['failures'], 1)
+          self.metrics.observe(dc, service, None, 'skipped')
+          raise CircuitOpen('%s %s is unavailable' % (dc, service))
+    return self.timeout(dc, service)
+
+  def finish(self, dc, service, callstart, result=None, error=None):
+    latency = time.time() - callstart
+    if isinstance(error, FDSNNoDataException):
+      # An answer without data still means the service is working
+      self.record(dc, service, True, latency)
+      self.metrics.observe(dc, service, latency, '204')
+    elif error is not None:
+      self.record(dc, service, False, latency)
+      self.metrics.observe(dc, service, latency, error_status(error))
+    else:
+      self.record(dc, service, True, latency)
+      if hasattr(result, 'status_code'):
+        status = str(result.status_code)
+      else:
+        status = '200'
+      self.metrics.observe(dc, service, latency, status)
+
+  def abandon(self, dc, service):
+    # A call without an outcome, an open circuit lets the next call through
+    # as its trial instead
+    with self.lock:
+      self.entry(dc, service)['trial'] = False
+
+  def record(self, dc, service, ok, latency):
+    with self.lock:
+      stats = self.entry(dc, service)
+      stats['calls'] += 1
+      stats['trial'] = False
+      if ok:
+        stats['latencies'].append(latency)
+        stats['consecutive'] = 0
+        if stats['state'] == 'open':
+          stats['state'] = 'closed'
+          print('*!!!* Circuit for %s %s closed again. *!!!*' % (dc, service))
+        return
+      stats['failures'] += 1
+      stats['consecutive'] += 1
+      stats['failed_time'] += latency
+      if self.failures <= 0:
+        return
+      if stats['state'] == 'open' or stats['consecutive'] >= self.failures:
+        if stats['state'] == 'closed':
+          stats['opens'] += 1
+          print('*!!!* Circuit for %s %s opened after %d failures. *!!!*'
+                % (dc, service, stats['consecutive']))
+        stats['state'] = 'open'
+        stats['opened'] = time.time()
+
+  def summary(self):
+    print('Node health summary:')
+    saved = 0.0
+    for (dc, service), stats in sorted(self.stats.items()):
+      latencies = list(stats['latencies'])
+      p50, p95 = numpy.percentile(latencies, [50, 95]) if latencies else (0.0, 0.0)
+      print('  %s %s: %d calls, %d failures, opened %d times, %d calls skipped, '
+            'latency p50 %.2f s p95 %.2f s' % (dc, service, stats['calls'], stats['failures'],
+                                             stats['opens'], stats['skipped'], p50, p95))
+      saved += stats['saved']
+    print('  %d channels recorded as node unavailable, about %.1f min saved by the circuit breaker'
+          % (self.unavailable, saved / 60.0))
+
+class TrackedClient(object):
+  """Wraps the obspy client so that all calls for a data center go through NodeHealth."""
+
+  def __init__(self, client, health, dc, eida_routing):
+    self.client = client
+    self.health = health
+    self.dc = dc
+    self.eida_routing = eida_routing
+    # The client of the async transport records its requests itself
+    self.recorded = getattr(client, 'health', None) is not None
+
+  def call(self, service, method, **kwargs):
+    if self.recorded:
+      return getattr(self.client, method)(**kwargs)
+    def request(timeout):
+      # The routing client serves several data centers, so its timeout is
+      # only adapted with single node clients
+      if not self.eida_routing:
+        self.client.timeout = timeout
+      return getattr(self.client, method)(**kwargs)
+    return self.health.call(self.dc, service, request)
+
+  def get_stations(self, **kwargs):
+    return self.call('station', 'get_stations', **kwargs)
+
+  def get_waveforms(self, **kwargs):
+    return self.received(self.call('dataselect', 'get_waveforms', **kwargs))
+
+  def get_waveforms_bulk(self, bulk, **kwargs):
+    return self.received(self.call('dataselect', 'get_waveforms_bulk', bulk=bulk, **kwargs))
+
+  def received(self, stream):
+    if self.recorded:
+      return stream
+    # The size of the miniSEED records is the best guess for the bytes
+    # received that obspy leaves us with
+    nbytes = 0
+    for tr in stream:
+      if 'mseed' in tr.stats:
+        nbytes += tr.stats.mseed.number_of_records * tr.stats.mseed.record_length
+    self.health.metrics.received(self.dc, 'dataselect', nbytes)
+    return stream
+
+class WFCatalogClient(object):
+  """Client for the WFCatalog with pooled sessions and cached routing."""
+
+  def __init__(self, sessions, health, routing_url, ttl=3600, max_span=366):
+    self.sessions = sessions
+    self.routing_url = routing_url
+    self.health = health
+    self.ttl = ttl
+    # Maximum number of days covered by a single metrics query. The default
+    # covers a whole year, the longest span a channel is probed in, so the
+    # sampled days of a channel are usually fetched with one query
+    self.max_span = max_span
+    self.lock = threading.Lock()
+    self.routes = {}
+
+  def session(self, url):
+    return self.sessions.get(url)
+
+  def route(self, net, sta, cha):
+    key = (net, sta, cha)
+    with self.lock:
+      if key in self.routes and self.routes[key][1] > time.time():
+        return self.routes[key][0]
+    params = dict(network=net, station=sta, channel=cha,
+                  format='post', service='wfcatalog')
+    def request(timeout):
+      r = self.session(self.routing_url).get(self.routing_url, params=params,
+                                             timeout=timeout)
+      if r.status_code == 200:
+        return r
+      raise Exception('No routing information for WFCatalog: %s' % params)
+    netloc = urlparse(self.routing_url).netloc
+    r = self.health.call(netloc, 'routing', request)
+    self.health.metrics.received(netloc, 'routing', len(r.content))
     wfcurl = r.content.decode('utf-8').splitlines()[0]
+    with self.lock:
+      self.routes[key] = (wfcurl, time.time() + self.ttl)
+    return wfcurl
+
+  def metrics(self, net, sta, cha, start, end):
+    wfcurl = self.route(net, sta, cha)
+    params = dict()
+    params['network'] = net
+    params['station'] = sta
+    params['channel'] = cha
+    # No time can be included in these parameters because the WFCatalog
+    # at BGR seems to have problems with it
+    params['start'] = '%d-%02d-%02d' % (start.year, start.month, start.day)
+    params['end'] = '%d-%02d-%02d' % (end.year, end.month, end.day)
+    params['include'] = 'sample'
+    params['longestonly'] = 'false'
+    params['minimumlength'] = 0.0
+    def request(timeout):
+      r = self.session(wfcurl).get(wfcurl, params=params, timeout=timeout)
+      if r.status_code in (200, 204):
+        return r
+      raise Exception('No metrics for %s.%s %s' % (net, sta, start))
+    netloc = urlparse(wfcurl).netloc
+    r = self.health.call(netloc, 'wfcatalog', request)
+    self.health.metrics.received(netloc, 'wfcatalog', len(r.content))
+    if r.status_code == 204:
+      return []
+    return json.loads(r.content.decode('utf-8'))
+
+  def days_with_metrics(self, net, sta, cha, realstart, days):
+    # Group the sampled days into as few range queries as possible and
+    # split the daily metric documents back into hits per sampled day
+    dates = {}
+    for day in days:
+      auxstart = realstart + day * (60*60*24)
+      dates[day] = datetime.date(auxstart.year, auxstart.month, auxstart.day)
+    groups = []
+    for day in sorted(days, key=lambda d: dates[d]):
+      if groups and (dates[day] - dates[groups[-1][0]]).days < self.max_span:
+        groups[-1].append(day)
+      else:
+        groups.append([day])
+    hits = set()
+    for group in groups:
+      first = dates[group[0]]
+      last = dates[group[-1]] + datetime.timedelta(days=1)
+      try:
+        metrics = self.metrics(net, sta, cha, first, last)
+      except Exception as e:
+        print(e)
+        continue
+      covered = set(doc['start_time'][:10] for doc in metrics if 'start_time' in doc)
+      for day in group:
+        if dates[day].isoformat() in covered:
+          hits.add(day)
+    return hits
+
+def window_bounds(args, realstart, day, hour):
+  start = realstart + day * (60*60*24) + hour * (60*60)
+  end = start + (args.minutes * 60)
+  return start, end
+
+def wilson_interval(fraction, count, confidence):
+  # Score interval of the retrievability, counting the covered fraction of
+  # the windows as successes. It stays wide for few windows, even if all of
+  # them were fully covered.
+  if count == 0:
+    return 0.0, 1.0
+  fraction = min(1.0, fraction)
+  z = NormalDist().inv_cdf(0.5 + confidence / 2)
+  denom = 1 + z * z / count
+  centre = (fraction + z * z / (2 * count)) / denom
+  half = z * math.sqrt(fraction * (1 - fraction) / count + z * z / (4 * count * count)) / denom
+  return max(0.0, centre - half), min(1.0, centre + half)
+
+def unanimous(covered, full_time, tolerance=0.01):
+  # The best location code covered all windows or none of them, give or
+  # take a sample, counted like the retrievability
+  return covered >= (1 - tolerance) * full_time or covered <= tolerance * full_time
+
+def fetch_window(rsClient, net, sta, cha, start, end):
+  try:
+    return rsClient.get_waveforms(network=net,
+                                  station=sta,
+                                  location='*',
+                                  channel=cha,
+                                  starttime=start,
+                                  endtime=end)
+  except Exception as e:
+    return e
+
+def window_bulk(windows):
+  return [(net, sta, '*', cha, start, end) for net, sta, cha, start, end in windows]
+
+def fetch_windows(rsClient, args, windows):
+  # Fetch a list of (net, sta, cha, start, end) windows with as few
+  # dataselect POST requests as possible. For every window either the
+  # Stream cut to the window or the exception of the request is returned.
+  streams = []
+  for i in range(0, len(windows), args.bulk_size):
+    chunk = windows[i:i+args.bulk_size]
+    bulk = window_bulk(chunk)
+    try:
+      data = rsClient.get_waveforms_bulk(bulk)
+    except (FDSNNoDataException, CircuitOpen) as e:
+      streams += [e] * len(chunk)
+      continue
+    except Exception as e:
+      if not bulk_rejected(e):
+        # Timeouts and connection errors would fail the same way again
+        streams += [e] * len(chunk)
+        continue
+      # Some nodes reject bulk requests, ask for every window on its own
+      print('Bulk request rejected, falling back to single requests: %s' % e)
+      rsClient.health.metrics.retry(rsClient.dc, 'dataselect', len(chunk))
+      streams += [fetch_window(rsClient, *window) for window in chunk]
+      continue
+    for net, sta, cha, start, end in chunk:
+      data_temp = data.select(network=net, station=sta, channel=cha).slice(start, end).copy()
+      if len(data_temp) == 0:
+        data_temp = FDSNNoDataException('No data available for %s.%s.%s %s - %s'
+                                        % (net, sta, cha, start, end))
+      streams.append(data_temp)
+  return streams
+
+def rejection_status(e):
+  # HTTP status of a request refused by the server, None for timeouts,
+  # connection errors and failures without an answer
+  if isinstance(e, requests.HTTPError) and e.response is not None:
+    return e.response.status_code
+  if isinstance(e, FDSNBadRequestException):
+    return 400
+  if isinstance(e, FDSNRequestTooLargeException):
+    return 413
+  if isinstance(e, NotImplementedError):
+    # obspy raises it for a 414 (URI too long)
+    return 414
+  if isinstance(e, FDSNException):
+    match = re.match(r'Unknown HTTP code: (\d+)', str(e.args[0]) if e.args else '')
+    return int(match.group(1)) if match else None
+  status = getattr(e, 'status', None)
+  return status if isinstance(status, int) else None
+
+def bulk_rejected(e):
+  # Only a refusal of the request itself is worth single requests; after a
+  # rate limit they would only make it worse
+  status = rejection_status(e)
+  return status is not None and 400 <= status < 500 and status != 429
+
+def fetch_headers(limiter, args, windows):
+  # Header mode counterpart of fetch_windows(): the miniSEED records are read
+  # as they arrive and only their headers are kept. For every window either
+  # the time covered per location code or the exception is returned.
+  size = args.bulk_size if args.bulk != 'none' else 1
+  coverage = []
+  for i in range(0, len(windows), size):
+    chunk = windows[i:i+size]
+    records = [None] * len(chunk)
+    for url, indices in chunk_routes(limiter, chunk):
+      if url is None:
+        for j in indices:
+          records[j] = Exception('No dataselect service known for %s.%s.%s' % chunk[j][:3])
+        continue
+      try:
+        url_records = request_headers(limiter, args, url, [chunk[j] for j in indices])
+      except Exception as e:
+        if len(indices) == 1 or not bulk_rejected(e):
+          for j in indices:
+            records[j] = e
+          continue
+        # Some nodes reject bulk requests, ask for every window on its own
+        print('Bulk request rejected, falling back to single requests: %s' % e)
+        limiter.health.metrics.retry(limiter.datacenter_of(url), 'dataselect', len(indices))
+        for j in indices:
+          try:
+            records[j] = request_headers(limiter, args, url, [chunk[j]])
+          except Exception as e:
+            records[j] = e
+      else:
+        for j in indices:
+          records[j] = url_records
+    for window, window_records in zip(chunk, records):
+      if isinstance(window_records, Exception):
+        coverage.append(window_records)
+        continue
+      net, sta, cha, start, end = window
+      window_covered = window_coverage(window_records, net, sta, cha, start.timestamp,
+                                       end.timestamp, args.minutes * 60.0)
+      if len(window_covered) == 0:
+        window_covered = FDSNNoDataException('No data available for %s.%s.%s %s - %s'
+                                             % (net, sta, cha, start, end))
+      coverage.append(window_covered)
+  return coverage
+
+def chunk_routes(limiter, chunk):
+  # Every window is sent to the data center serving its channel at its
+  # time, which for some networks is not the same for all of them. Returns
+  # (url, indices of the windows) per data center.
+  urls = [limiter.dataselect_url(net, sta, cha, start) for net, sta, cha, start, _ in chunk]
+  return [(url, [j for j, other in enumerate(urls) if other == url])
+          for url in sorted(set(urls), key=urls.index)]
+
+def header_body(windows):
+  return '\n'.join('%s %s * %s %s %s' % (net, sta, cha, start.format_iris_web_service(),
+                                         end.format_iris_web_service())
+                   for net, sta, cha, start, end in windows)
+
+def request_headers(limiter, args, url, windows):
+  if limiter.client is not None:
+    # The async transport reads the headers on its event loop
+    return limiter.client.get_records(url, header_body(windows))
+  session = limiter.sessions.get(url)
+  def request(timeout):
+    if len(windows) == 1:
+      net, sta, cha, start, end = windows[0]
+      r = session.get(url, params=dict(network=net, station=sta, location='*', channel=cha,
+                                       starttime=start.format_iris_web_service(),
+                                       endtime=end.format_iris_web_service()),
+                      timeout=timeout, stream=True)
+    else:
+      r = session.post(url, data=header_body(windows), timeout=timeout, stream=True)
+    if r.status_code not in (200, 204):
+      r.close()
+      r.raise_for_status()
+      raise Exception('Dataselect request failed with status %d' % r.status_code)
+    return r
+  # Recorded under the same data center as the requests of the obspy
+  # client, so the circuit breaker sees the failures of both
+  dc = limiter.datacenter_of(url)
+  r = limiter.health.call(dc, 'dataselect', request)
+  nbytes = 0
+  with r:
+    if r.status_code == 204:
+      return []
+    reader = HeaderReader()
+    for chunk in r.iter_content(chunk_size=64*1024):
+      nbytes += len(chunk)
+      reader.feed(chunk)
+  limiter.health.metrics.received(dc, 'dataselect', nbytes)
+  return reader.records
+
+def response_ok(inventory, net, sta, cha):
+  # The response must be finite and non-zero at a few frequencies below the
+  # Nyquist frequency of every matching channel
+  channels = inventory.select(network=net, station=sta, channel=cha)
+  if len(channels.get_contents()['channels']) == 0:
+    return False
+  for network in channels:
+    for station in network:
+      for channel in station:
+        nyquist = 0.5 * channel.sample_rate if channel.sample_rate else 10.0
+        freqs = [f for f in (0.05, 0.5, 5.0) if f < nyquist]
+        try:
+          values = channel.response.get_evalresp_response_for_frequencies(freqs, output='VEL')
+        except Exception:
+          return False
+        if not all(numpy.isfinite(values)) or not all(values != 0):
+          return False
+  return True
+
+def node_unavailable(rsClient, y, net, sta, cha, curchannel, totchannels):
+  with rsClient.health.lock:
+    rsClient.health.unavailable += 1
+  print('%d/%d; Node unavailable; %d %s %s %s; %s'
+        % (curchannel, totchannels, y, net, sta, cha, rsClient.dc))
+  return {'status': 'node unavailable'}
+
+def probe_channel(rsClient, wfc, args, node, y, net, sta, cha, realstart, realend,
+                  windows, curchannel, totchannels, epoch, waveforms=None,
+                  responses=None, fetch=None):
+  # Keep track of the amount of time per request
+  reqstart = time.time()
+  # Do not wait for data centers that are known to be down
+  if rsClient.health.is_open(rsClient.dc, 'dataselect'):
+    return node_unavailable(rsClient, y, net, sta, cha, curchannel, totchannels)
+  # Time covered per location code, summed over all windows
+  coverage = {}
+  hours_with_data = 0
+  probed = []
+  # Get the inventory for the whole year to test
+  metadataProblem = False
+  try:
+    if responses is None:
+      inventory = rsClient.get_stations(network=net,
+                                        station=sta,
+                                        channel=cha,
+                                        starttime=realstart,
+                                        endtime=realend,
+                                        level='response')
+    else:
+      # The cache holds the response of the whole channel epoch
+      inventory = responses.get(rsClient, net, sta, cha, epoch)
+  except Exception:
+    # If there are problems retrieving metadata signal it in metadataProblem
+    metadataProblem = True
+  # In header mode the response is evaluated once instead of being removed
+  # from every window
+  if args.coverage == 'headers' and not metadataProblem:
+    checkstart = time.time()
+    if not response_ok(inventory, net, sta, cha):
+      metadataProblem = True
+      print('Error with metadata!')
+    rsClient.health.metrics.observe(rsClient.dc, 'response_check',
+                                    time.time() - checkstart, 'ok')
+  if fetch is None:
+    def fetch(batch):
+      return [fetch_window(rsClient, net, sta, cha, *window_bounds(args, realstart, day, hour))
+              for day, hour in batch]
+  # In adaptive mode the windows are probed in batches, until the confidence
+  # interval of the retrievability is narrow enough
+  batch_size = args.initial_windows if args.sampling == 'adaptive' else len(windows)
+  pending = list(windows)
+  while pending:
+    batch, pending = pending[:batch_size], pending[batch_size:]
+    # get the data, unless it was already fetched in a bulk request
+    missing = [window for window in batch if waveforms is None or window not in waveforms]
+    fetched = dict(zip(missing, fetch(missing))) if missing else {}
+    for day, hour in batch: # loop through the random days and hours
+      start, end = window_bounds(args, realstart, day, hour)
+      probed.append((day, hour))
+      try:
+        data_temp = fetched[(day, hour)] if (day, hour) in fetched else waveforms[(day, hour)]
+        if isinstance(data_temp, Exception):
+          raise data_temp
+        if args.coverage == 'headers':
+          # The coverage per location was already taken from the record headers
+          window_covered = data_temp
+        else:
+          data_temp.trim(starttime=start, endtime=end)
+          # Test metadata only in the case that we think it is OK
+          if not metadataProblem:
+            for tr in data_temp:
+              removestart = time.time()
+              tr.remove_response(inventory=inventory)
+              rsClient.health.metrics.observe(rsClient.dc, 'remove_response',
+                                              time.time() - removestart, 'ok')
+              if tr.data[0] != tr.data[0]:
+                metadataProblem = True
+                print('Error with metadata!')
+                break
+          window_covered = {}
+          for tr in data_temp:
+            # Maximum of time is what we requested. If the DC sends
+            # more we consider only the requested time
+            time_covered = min(tr.stats.endtime - tr.stats.starttime,
+                               args.minutes * 60.0)
+            window_covered[tr.stats.location] = window_covered.get(tr.stats.location, 0) + time_covered
+        for loc, time_covered in window_covered.items():
+          coverage[loc] = coverage.get(loc, 0) + time_covered
+        hours_with_data += 1
+      except Exception as e:
+        print(y, cha, node, net, sta, day, hour, e)
+        print('----------------------------')
+    if args.sampling == 'adaptive':
+      covered = max(coverage.values()) if coverage else 0.0
+      full_time = len(probed) * args.minutes * 60
+      low, high = wilson_interval(covered / full_time, len(probed), args.confidence)
+      # With --early_stop, channels that are fully available or not at all
+      # stop before the interval is narrow enough
+      if (high - low) / 2 <= args.target_interval or \
+         (args.early_stop and unanimous(covered, full_time)):
+        break
+    batch_size = args.initial_windows
+  # The circuit opened while probing this channel
+  if hours_with_data == 0 and rsClient.health.is_open(rsClient.dc, 'dataselect'):
+    return node_unavailable(rsClient, y, net, sta, cha, curchannel, totchannels)
+  # Check WFCatalog for all the probed days at once
+  probed_days = sorted(set(day for day, _ in probed))
+  days_with_metrics = len(wfc.days_with_metrics(net, sta, cha, realstart, probed_days))
+  full_time = len(probed) * args.minutes * 60
+  if hours_with_data > 0 and len(coverage) > 0: # check how much data was downloaded
+    # With several location codes the best covered one counts
+    total_time_covered = max(coverage.values())
+    percentage_covered = total_time_covered / full_time
   else:
-    raise Exception('No routing information for WFCatalog: %s' % params)
-  del params['format']
-  del params['service']
-  params['include'] = 'sample'
-  params['longestonly'] = 'false'
-  params['minimumlength'] = 0.0
-  r = requests.get(wfcurl, params)
-  if r.status_code == 200:
-    metrics = json.loads(r.content.decode('utf-8'))
+    total_time_covered = 0.0
+    percentage_covered = 0.0
+  low, high = wilson_interval(percentage_covered, len(probed), args.confidence)
+  minutes = (time.time()-reqstart)/60.0
+  print('%d/%d; %8.2f min; %d %s %s %s; perc received %3.1f (%3.1f-%3.1f, %d windows); perc w/metrics %3.1f; %s' %
+        (curchannel, totchannels, minutes, y, net, sta, cha,
+         percentage_covered * 100.0, low * 100.0, high * 100.0, len(probed),
+         days_with_metrics*100.0/max(len(probed_days), 1),
+         'ERROR' if metadataProblem else 'OK'))
+  result = {'percentage': percentage_covered,
+            'percentage_interval': [low, high],
+            'windows': len(probed),
+            'days_with_metrics': days_with_metrics,
+            'metadata_problem': metadataProblem}
+  if args.sampling == 'adaptive':
+    # False if --max_windows or --early_stop ended the sampling first
+    result['target_reached'] = (high - low) / 2 <= args.target_interval
+  return result
+
+class NodeLimiter(object):
+  """Caps the number of channels probed at the same time per data center."""
+
+  def __init__(self, node, eida_routing, limit, timeout, sessions, health, routing_url,
+               base_url=None, client=None, queued=1):
+    self.node = node
+    self.routing_url = routing_url
+    self.health = health
+    self.eida_routing = eida_routing
+    self.limit = limit
+    self.timeout = timeout
+    self.sessions = sessions
+    self.base_url = base_url
+    # Client of the async transport, which sends the requests of the groups
+    # ahead and limits the requests per host itself
+    self.client = client
+    # Groups sent ahead whose answers wait for a probing thread
+    self.queued = threading.BoundedSemaphore(queued)
+    self.lock = threading.Lock()
+    self.routes = {}
+    self.semaphores = {}
+
+  def dataselect_routes(self, net):
+    # List of (url, streams) of the data centers serving the network
+    if not self.eida_routing:
+      return [(self.base_url + '/fdsnws/dataselect/1/query', None)]
+    with self.lock:
+      if net in self.routes:
+        return self.routes[net]
+    # With the routing client the data centers are only known after asking
+    # the routing service, which is done once per network
+    routes = []
+    def request(timeout):
+      return self.sessions.get(self.routing_url).get(
+        self.routing_url, params=dict(network=net, service='dataselect', format='post'),
+        timeout=timeout)
+    try:
+      r = self.health.call(urlparse(self.routing_url).netloc, 'routing', request)
+      if r.status_code == 200:
+        routes = parse_routes(r.content.decode('utf-8'))
+    except Exception as e:
+      print('No routing information for %s: %s' % (net, e))
+    with self.lock:
+      self.routes[net] = routes
+    return routes
+
+  def dataselect_url(self, net, sta=None, cha=None, starttime=None):
+    return route_url(self.dataselect_routes(net), net, sta, cha, starttime)
+
+  def datacenter_of(self, url):
+    # Key of the data center in the node health and the metrics
+    if not self.eida_routing or url is None:
+      return self.node
+    return urlparse(url).netloc
+
+  def datacenter(self, net):
+    return self.datacenter_of(self.dataselect_url(net))
+
+  def semaphore(self, net):
+    # Only used with the blocking transport
+    dc = self.datacenter(net)
+    with self.lock:
+      if dc not in self.semaphores:
+        self.semaphores[dc] = threading.BoundedSemaphore(self.limit)
+      return self.semaphores[dc]
+
+# Everything needed to probe a single channel, in the order of the
+# arguments of probe_channel()
+Probe = namedtuple('Probe', ['net', 'sta', 'cha', 'realstart', 'realend', 'windows',
+                             'curchannel', 'totchannels', 'epoch'])
+
+def first_windows(args, probes):
+  # The first batch of windows of all channels is fetched together; in
+  # adaptive mode, further windows are requested per channel as needed
+  first = [probe.windows[:args.initial_windows] if args.sampling == 'adaptive' else probe.windows
+           for probe in probes]
+  windows = []
+  for probe, batch in zip(probes, first):
+    for day, hour in batch:
+      windows.append((probe.net, probe.sta, probe.cha)
+                     + window_bounds(args, probe.realstart, day, hour))
+  return first, windows
+
+def send_ahead(keys, limiter, responses, args, probes):
+  # With the async transport, the requests that probe_group() starts with
+  # are sent as coroutines as soon as the group is queued, so they are in
+  # flight while the probing threads are still busy with earlier groups.
+  # The keys of the requests are added to keys, to drop unused answers.
+  client = limiter.client
+  if responses is None:
+    for probe in probes:
+      keys.append(client.prefetch_stations(network=probe.net, station=probe.sta, channel=probe.cha,
+                                           starttime=probe.realstart, endtime=probe.realend,
+                                           level='response'))
   else:
-    raise Exception('No metrics for %s.%s %s' % (net, sta, start))
-  return metrics
+    missing = responses.missing([(probe.net, probe.sta, probe.cha, probe.epoch) for probe in probes])
+    if missing:
+      keys.append(client.prefetch_stations(**responses.query(missing)))
+  first, windows = first_windows(args, probes)
+  if args.bulk == 'none' and args.coverage == 'full':
+    for probe, batch in zip(probes, first):
+      for day, hour in batch:
+        window = (probe.net, probe.sta, probe.cha) + window_bounds(args, probe.realstart, day, hour)
+        keys.append(client.prefetch_waveforms_bulk(window_bulk([window])))
+  elif args.coverage == 'full':
+    for i in range(0, len(windows), args.bulk_size):
+      keys.append(client.prefetch_waveforms_bulk(window_bulk(windows[i:i+args.bulk_size])))
+  else:
+    size = args.bulk_size if args.bulk != 'none' else 1
+    for i in range(0, len(windows), size):
+      chunk = windows[i:i+size]
+      for url, indices in chunk_routes(limiter, chunk):
+        if url is not None:
+          keys.append(client.prefetch_records(url, header_body([chunk[j] for j in indices])))
+
+def probe_group(limiter, rsClient, wfc, responses, log, args, node, y, probes):
+  # Probe a group of channels, fetching the responses and the waveforms of
+  # all their windows first if prefetching or bulk mode are enabled. Every
+  # finished channel is written to the result log right away.
+  rsClient = TrackedClient(rsClient, limiter.health, limiter.datacenter(probes[0].net),
+                           args.eida_routing)
+  if responses is not None and len(probes) > 1:
+    try:
+      responses.prefetch(rsClient, [(probe.net, probe.sta, probe.cha, probe.epoch)
+                                    for probe in probes])
+    except Exception as e:
+      # The channels will ask for their responses one by one
+      print('Failed to prefetch responses: %s' % e)
+  if args.bulk == 'none' and args.coverage == 'full':
+    for probe in probes:
+      log.write(node, y, probe.net, probe.sta, probe.cha,
+                probe_channel(rsClient, wfc, args, node, y, *probe, responses=responses))
+    return
+  def fetcher(probe):
+    def fetch(batch):
+      windows = [(probe.net, probe.sta, probe.cha) + window_bounds(args, probe.realstart, day, hour)
+                 for day, hour in batch]
+      if args.coverage == 'headers':
+        return fetch_headers(limiter, args, windows)
+      return fetch_windows(rsClient, args, windows)
+    return fetch
+  first, windows = first_windows(args, probes)
+  if args.coverage == 'headers':
+    streams = iter(fetch_headers(limiter, args, windows))
+  else:
+    streams = iter(fetch_windows(rsClient, args, windows))
+  for probe, batch in zip(probes, first):
+    waveforms = {}
+    for window in batch:
+      waveforms[window] = next(streams)
+    log.write(node, y, probe.net, probe.sta, probe.cha,
+              probe_channel(rsClient, wfc, args, node, y, *probe, waveforms=waveforms,
+                            responses=responses, fetch=fetcher(probe)))
+
+def limited_group(limiter, rsClient, wfc, responses, log, args, node, y, probes, keys=None):
+  if keys is not None:
+    # The requests were sent ahead, limited per host by the async transport
+    try:
+      probe_group(limiter, rsClient, wfc, responses, log, args, node, y, probes)
+    finally:
+      rsClient.forget(keys)
+      limiter.queued.release()
+    return
+  with limiter.semaphore(probes[0].net):
+    probe_group(limiter, rsClient, wfc, responses, log, args, node, y, probes)
+
+def group_key(args, net, sta, cha):
+  # Channels are grouped by the widest of the bulk and prefetch scopes
+  if 'network' in (args.bulk, args.prefetch):
+    return (net,)
+  elif 'station' in (args.bulk, args.prefetch):
+    return (net, sta)
+  return (net, sta, cha)
+
+def submit_group(executor, limiter, futures, rsClient, wfc, responses, log, args, node, y, group):
+  if executor is None:
+    probe_group(limiter, rsClient, wfc, responses, log, args, node, y, group)
+    return
+  keys = None
+  if limiter.client is not None:
+    # Wait for a queued group to be probed, which bounds the answers kept
+    # in memory until a thread gets to them
+    limiter.queued.acquire()
+    keys = []
+    try:
+      send_ahead(keys, limiter, responses, args, group)
+    except Exception as e:
+      # The remaining requests are sent by the probing thread
+      print('Failed to send the requests of %s ahead: %s' % (group[0].net, e))
+  futures.append(executor.submit(limited_group, limiter, rsClient, wfc, responses, log,
+                                 args, node, y, group, keys))
+
+class ResultLog(object):
+  """Append-only JSON Lines log of the finished channel results."""
+
+  def __init__(self, filename, resume=False):
+    self.filename = filename
+    self.lock = threading.Lock()
+    self.done = {}
+    if resume and os.path.exists(filename):
+      self.done = read_result_log(filename)
+      print('Resuming with %d channels from %s' % (len(self.done), filename))
+      self.output = open(filename, 'a')
+      # A crash may have left a partial last line behind
+      if os.path.getsize(filename) > 0:
+        with open(filename, 'rb') as infile:
+          infile.seek(-1, os.SEEK_END)
+          if infile.read(1) != b'\n':
+            self.output.write('\n')
+    else:
+      self.output = open(filename, 'w')
+
+  def write(self, node, y, net, sta, cha, result):
+    line = json.dumps({'node': node, 'year': y, 'network': net, 'station': sta,
+                       'channel': cha, 'result': result})
+    with self.lock:
+      self.output.write(line + '\n')
+      self.output.flush()
+
+  def close(self):
+    self.output.close()
+
+def read_result_log(filename):
+  done = {}
+  with open(filename) as infile:
+    for line in infile:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        # Skip lines that were cut off by a crash
+        continue
+      done[(entry['node'], entry['year'], entry['network'],
+            entry['station'], entry['channel'])] = entry['result']
+  return done
+
+def build_results(results, done):
+  # Fill the nested node/year/net/sta/cha layout with the logged results
+  for (node, y, net, sta, cha), result in done.items():
+    results.setdefault(node, {}).setdefault(y, {}).setdefault(net, {}) \
+           .setdefault(sta, {})[cha] = result
+  return results
 
 def main():
   # Default values for start and end time (last year)
@@ -78,9 +967,84 @@ def main():
                       help='Day of the month to end the test (default=31).')
   parser.add_argument('-r', '--eida_routing', default=True, type=bool,
                       help='Switch to choose between eida routing and individual node clients (default=True).')
+  parser.add_argument('-n', '--nodes', default=None, type=str,
+                      help='List of comma-separated FDSN nodes to query with individual clients instead of the EIDA nodes (default=None).')
+  parser.add_argument('--routing_url', default='http://www.orfeus-eu.org/eidaws/routing/1/query', type=str,
+                      help='URL of the EIDA routing service used for the WFCatalog (default=http://www.orfeus-eu.org/eidaws/routing/1/query).')
   parser.add_argument('-o', '--output_filename', default="results.json", type=str,
                       help='Filename to write the results to (default="results.json").')
+  parser.add_argument('-w', '--workers', default=1, type=int,
+                      help='Number of channels to probe concurrently (default=1).')
+  parser.add_argument('--node_workers', default=4, type=int,
+                      help='Maximum number of channels probed concurrently at a single data center (default=4).')
+  parser.add_argument('--seed', default=None, type=int,
+                      help='Seed for the random selection of days and hours (default=None).')
+  parser.add_argument('--wfc_ttl', default=3600, type=int,
+                      help='Seconds to keep WFCatalog routing information cached (default=3600).')
+  parser.add_argument('--wfc_max_span', default=366, type=int,
+                      help='Maximum number of days covered by a single WFCatalog query (default=366).')
+  parser.add_argument('-b', '--bulk', default='channel', choices=['none', 'channel', 'station', 'network'],
+                      help='Combine the waveform requests of a channel, station or network into bulk requests (default=channel).')
+  parser.add_argument('--bulk_size', default=100, type=int,
+                      help='Maximum number of time windows in a single bulk request (default=100).')
+  parser.add_argument('--log_filename', default=None, type=str,
+                      help='JSON Lines file the finished channels are written to during the run (default=output filename + ".jsonl").')
+  parser.add_argument('--resume', action='store_true',
+                      help='Continue an interrupted run, skipping the channels already in the log file.')
+  parser.add_argument('--response_cache', default=None, type=str,
+                      help='Directory to cache the response metadata in between channels, years and runs (default=None).')
+  parser.add_argument('--response_cache_size', default=500, type=int,
+                      help='Maximum size of the response cache in MB (default=500).')
+  parser.add_argument('--response_refresh', action='store_true',
+                      help='Drop cached responses of channels that were updated since the last run.')
+  parser.add_argument('--prefetch', default='none', choices=['none', 'station', 'network'],
+                      help='Fetch the cached responses of a whole station or network with one request (default=none).')
+  parser.add_argument('--coverage', default='full', choices=['full', 'headers'],
+                      help='Compute the coverage from the decoded traces or only from the miniSEED record headers (default=full).')
+  parser.add_argument('--breaker_failures', default=5, type=int,
+                      help='Consecutive failures after which a data center service is considered down, 0 to disable (default=5).')
+  parser.add_argument('--breaker_retry', default=300, type=int,
+                      help='Seconds after which a service considered down is tried again (default=300).')
+  parser.add_argument('--adaptive_timeout', action='store_true',
+                      help='Adapt the timeouts to the observed latencies of each data center and service.')
+  parser.add_argument('--min_timeout', default=5, type=int,
+                      help='Lower limit for the adaptive timeouts in seconds (default=5).')
+  parser.add_argument('--prometheus_filename', default=None, type=str,
+                      help='Also write the request metrics to this Prometheus textfile (default=None).')
+  parser.add_argument('--inventory', default=None, type=str,
+                      help='JSON file to store the discovered channels in, shared with make_coordinate_list.py (default=None).')
+  parser.add_argument('--inventory_max_age', default=24, type=float,
+                      help='Number of hours after which the stored channels are discovered again (default=24).')
+  parser.add_argument('--shard', default=None, type=parse_shard,
+                      help='Only probe the channels of shard i out of N, given as i/N (default=None).')
+  parser.add_argument('--sampling', default='fixed', choices=['fixed', 'adaptive'],
+                      help='Probe days x hours windows per channel, or add windows until the confidence interval is narrow enough (default=fixed).')
+  parser.add_argument('--initial_windows', default=4, type=int,
+                      help='Number of windows probed at once in adaptive sampling mode (default=4).')
+  parser.add_argument('--max_windows', default=20, type=int,
+                      help='Maximum number of windows per channel in adaptive sampling mode (default=20).')
+  parser.add_argument('--target_interval', default=0.15, type=float,
+                      help='Half width of the confidence interval to reach in adaptive sampling mode (default=0.15).')
+  parser.add_argument('--early_stop', action='store_true',
+                      help='In adaptive sampling mode, stop as soon as a channel is fully available or not at all, even if the confidence interval is still wider than the target.')
+  parser.add_argument('--confidence', default=0.95, type=float,
+                      help='Confidence level of the retrievability interval (default=0.95).')
+  parser.add_argument('--transport', default='requests', choices=['requests', 'async'],
+                      help='Run the requests through obspy and requests, or all on one asyncio event loop (needs aiohttp) (default=requests).')
+  parser.add_argument('--connections', default=100, type=int,
+                      help='Maximum number of open connections of the async transport (default=100).')
+  parser.add_argument('--host_connections', default=8, type=int,
+                      help='Maximum number of concurrent requests per host with the async transport (default=8).')
+  parser.add_argument('--parse_workers', default=0, type=int,
+                      help='Number of processes to decode miniSEED data in with the async transport, 0 to decode in the probing threads (default=0).')
+  parser.add_argument('--queued_groups', default=200, type=int,
+                      help='Maximum number of channel groups whose requests are sent ahead of the probing threads with the async transport (default=200).')
   args = parser.parse_args()
+  random.seed(args.seed)
+  if args.shard is not None:
+    # All shards have to draw from the same seeds
+    shard_seed = args.seed if args.seed is not None else 0
+    assigned = []
   # List of networks to exclude
   if args.exclude is not None:
     nets2exclude = list(map(str.strip, args.exclude.split(',')))
@@ -88,16 +1052,42 @@ def main():
     nets2exclude = list()
   # Create a client to the EIDA Routing Service
   token = args.authentication
-  if args.eida_routing:
+  if args.nodes is not None:
+   # Explicitly given nodes are always queried with individual clients
+   args.eida_routing = False
+   eida_nodes = list(map(str.strip, args.nodes.split(',')))
+  elif args.eida_routing:
    eida_nodes = ["eida-routing"]
   else:
    eida_nodes = [ "http://eida.geo.uib.no", "GFZ", "RESIF", "INGV", "ETH", "BGR", "NIEP", "KOERI", "LMU", "NOA", "ICGC", "ODC" ]
+  if args.transport == 'async':
+    # All requests share one event loop instead of a pool per endpoint
+    sessions = AsyncTransport(limit=args.connections, per_host=args.host_connections)
+    parse_pool = ProcessPoolExecutor(max_workers=args.parse_workers) if args.parse_workers > 0 else None
+  else:
+    sessions = SessionPool(pool_size=max(args.workers, 1))
+  metrics = RequestMetrics()
+  health = NodeHealth(metrics, failures=args.breaker_failures, retry=args.breaker_retry,
+                      timeout=args.timeout, min_timeout=args.min_timeout,
+                      adaptive=args.adaptive_timeout)
+  wfc = WFCatalogClient(sessions, health, args.routing_url, ttl=args.wfc_ttl,
+                        max_span=args.wfc_max_span)
+  log = ResultLog(args.log_filename or args.output_filename + '.jsonl', args.resume)
+  if args.response_cache is not None:
+    responses = ResponseCache(args.response_cache, args.response_cache_size)
+  else:
+    responses = None
+  inventory = ChannelInventory(args.inventory, args.inventory_max_age)
   results = {}
   for node in eida_nodes:
     results[node] = {}
     print("Initializing "+node+" client.")
     try:
-      if args.eida_routing:
+      if args.transport == 'async':
+        # Restricted data is never requested, so no token is needed
+        rsClient = TransportClient(sessions, None if args.eida_routing else node,
+                                   args.routing_url, args.timeout, parse_pool, health)
+      elif args.eida_routing:
         rsClient = RoutingClient("eida-routing",timeout=args.timeout,credentials={'EIDA_TOKEN': token})
       else:
         rsClient = Client(base_url=node,timeout=args.timeout,eida_token=token)
@@ -107,9 +1097,33 @@ def main():
         rsClient = RoutingClient("eida-routing",timeout=args.timeout)
       else:
         rsClient = Client(base_url=node,timeout=args.timeout)
+    if responses is not None and args.response_refresh:
+      responses.invalidate_updated(rsClient)
+    limiter = NodeLimiter(node, args.eida_routing, args.node_workers, args.timeout, sessions,
+                          health, args.routing_url, None if args.eida_routing else rsClient.base_url,
+                          rsClient if args.transport == 'async' else None, args.queued_groups)
+    if args.transport == 'async':
+      # The client records its requests under the same data center keys
+      rsClient.datacenter = limiter.datacenter_of
     years = range(args.start, args.end+1)
-    for index,y in enumerate(years):
+    for y in years:
       results[node][y] = {}
+    # The channels of all years are discovered with a single request, which
+    # does not include restricted streams. Only a stored inventory is shared
+    # with make_coordinate_list.py, which needs all *HZ channels.
+    discover = CHANNELS if args.inventory is not None else ','.join(TESTED_CHANNELS)
+    try:
+      channel_index = inventory.index(
+        node, UTCDateTime(args.start, args.start_month, args.start_day),
+        UTCDateTime(args.end, args.end_month, args.end_day),
+        lambda starttime, endtime: TrackedClient(rsClient, health, node, args.eida_routing).get_stations(
+          level='channel', channel=discover, starttime=starttime, endtime=endtime,
+          includerestricted=False))
+    except Exception as e:
+      print('No Stations available at node: '+node)
+      print(e)
+      continue
+    for index,y in enumerate(years):
       print('Processing year %d' % y)
       if index == 0:
         t0 = UTCDateTime(y, args.start_month, args.start_day)
@@ -119,135 +1133,101 @@ def main():
         t1 = UTCDateTime(y, args.end_month, args.end_day)
       else:
         t1 = UTCDateTime(y, 12, 31, 23, 59, 59)
-      # Do not include restricted streams
       try:
-        st = rsClient.get_stations(level='channel', channel='BHZ,HHZ', starttime=t0, endtime=t1,
-                      includerestricted=False)
-        totchannels = len(st.get_contents()['channels'])
-        print('# %s' % st.get_contents()['channels'])
-        print('# %d channels found' % len(st.get_contents()['channels']))
+        channels = channel_index.select(t0, t1, TESTED_CHANNELS)
+        if args.shard is not None:
+          channels = [cha for cha in channels
+                      if shard_of(cha.network, cha.station, cha.channel, args.shard[1]) == args.shard[0]]
+          assigned += set((node, y, cha.network, cha.station, cha.channel) for cha in channels)
+        totchannels = len(channels)
+        print('# %s' % ['%s.%s.%s.%s' % epoch[:4] for epoch in channels])
+        print('# %d channels found' % totchannels)
         curchannel = 0
-        for net in st:
-          results[node][y][net.code] = {}
-          for sta in net:
-            results[node][y][net.code][sta.code] = {}
-            for cha in sta:
-              results[node][y][net.code][sta.code][cha.code] = {}
-              curchannel += 1
-              if net.code in nets2exclude:
-                print('%d/%d; Network %s is blacklisted'
-                      % (curchannel, totchannels, net.code))
-                continue
-              # Keep track of the amount of time per request
-              reqstart = time.time()
-              data = Stream()
-              # Days should be restricted to the days in which the stream is open
-              realstart = max(t0, cha.start_date)
-              realend = min(t1, cha.end_date) if cha.end_date is not None else t1
-              totaldays = int((realend - realstart) / (60 * 60 * 24))
-              # We have less days in the epoch than samples to select
-              if totaldays <= args.days:
-                print('%d/%d; Skipped because of a short epoch; %d %s %s %s'
-                      % (curchannel, totchannels, y, net.code, sta.code, cha.code))
-                continue
-              days = random.sample(range(1, totaldays+1), args.days)
-              hours = random.sample(range(0, 24),
-                                    args.hours) # create random set of hours and days for download test
-              hours_with_data = 0
-              days_with_metrics = 0
-              # Get the inventory for the whole year to test
-              metadataProblem = False
-              try:
-                inventory = rsClient.get_stations(network=net.code,
-                                                  station=sta.code,
-                                                  channel=cha.code,
-                                                  starttime=realstart,
-                                                  endtime=realend,
-                                                  level='response')
-              except Exception:
-                # If there are problems retrieving metadata signal it in metadataProblem
-                metadataProblem = True
-              # for day in tqdm(days) : # loop through all the random days
-              for day in days: # loop through all the random days
-                # Check WFCatalog for that day
-                try:
-                  auxstart = realstart + day * (60*60*24)
-                  auxend = realstart + (day+1) * (60*60*24)
-                  _ = wfcatalog(net.code, sta.code, cha.code, auxstart, auxend)
-                  days_with_metrics += 1
-                except Exception as e:
-                  print(e)
-                for hour in hours: # loop through all the random hours (same for each day)
-                  start = realstart + day * (60*60*24) + hour * (60*60)
-                  end = start + (args.minutes * 60)
-                  try:
-                    # get the data
-                    data_temp = rsClient.get_waveforms(network=net.code,
-                                                       station=sta.code,
-                                                       location='*',
-                                                       channel=cha.code,
-                                                       starttime=start,
-                                                       endtime=end)
-                    data_temp.trim(starttime=start, endtime=end)
-                    # Test metadata only in the case that we think it is OK
-                    if not metadataProblem:
-                      for tr in data_temp:
-                        tr.remove_response(inventory=inventory)
-                        if tr.data[0] != tr.data[0]:
-                          metadataProblem = True
-                          print('Error with metadata!')
-                          break
-                    data += data_temp
-                    hours_with_data += 1
-                  except Exception as e:
-                    print(y, cha, node, net, sta, day, hour, e)
-                    print('----------------------------')
-              full_time = args.days * args.hours * args.minutes * 60
-              if hours_with_data > 0: # check how much data was downloaded
-                locs = []
-                for tr in data:
-                  locs.append(tr.stats.location)
-                locs = list(set(locs))
-                if len(locs) > 1:
-                  completeness_by_loc = [[], [], []]
-                  for loc in locs:
-                    data_temp = data.copy().select(location=loc)
-                    total_time_covered = 0
-                    for tr in data_temp:
-                      time_covered = min(tr.stats.endtime - tr.stats.starttime,
-                                         args.minutes*60.0)
-                      total_time_covered += time_covered
-                    percentage_covered = total_time_covered / full_time
-                    completeness_by_loc[0].append(loc)
-                    completeness_by_loc[1].append(total_time_covered)
-                    completeness_by_loc[2].append(percentage_covered)
-                  percentage_covered = max(completeness_by_loc[2])
-                  total_time_covered = max(completeness_by_loc[1])
-                else:
-                  total_time_covered = 0
-                  for tr in data:
-                    # Maximum of time is what we requested. If the DC sends
-                    # more we consider only the requested time
-                    time_covered = min(tr.stats.endtime - tr.stats.starttime,
-                                       args.minutes * 60.0)
-                    total_time_covered += time_covered
-                  percentage_covered = total_time_covered / full_time
-              else:
-                total_time_covered = 0.0
-                percentage_covered = 0.0
-              minutes = (time.time()-reqstart)/60.0
-              print('%d/%d; %8.2f min; %d %s %s %s; perc received %3.1f; perc w/metrics %3.1f; %s' %
-                    (curchannel, totchannels, minutes, y, net.code, sta.code, cha.code,
-                     percentage_covered * 100.0, days_with_metrics*100.0/args.days,
-                     'ERROR' if metadataProblem else 'OK'))
-              results[node][y][net.code][sta.code][cha.code] = {'percentage': percentage_covered,
-                                                                'days_with_metrics': days_with_metrics,
-                                                                'metadata_problem': metadataProblem}
+        futures = []
+        group = []
+        groupkey = None
+        # The async transport always probes in threads, so the requests of the
+        # following groups can be sent ahead
+        executor = ThreadPoolExecutor(max_workers=args.workers) \
+                   if args.workers > 1 or args.transport == 'async' else None
+        for cha in channels:
+          results[node][y].setdefault(cha.network, {}).setdefault(cha.station, {})[cha.channel] = {}
+          curchannel += 1
+          if cha.network in nets2exclude:
+            print('%d/%d; Network %s is blacklisted'
+                  % (curchannel, totchannels, cha.network))
+            continue
+          # Days should be restricted to the days in which the stream is open
+          realstart = max(t0, cha.start_date)
+          realend = min(t1, cha.end_date) if cha.end_date is not None else t1
+          totaldays = int((realend - realstart) / (60 * 60 * 24))
+          # We have less days in the epoch than samples to select
+          if totaldays <= args.days:
+            print('%d/%d; Skipped because of a short epoch; %d %s %s %s'
+                  % (curchannel, totchannels, y, cha.network, cha.station, cha.channel))
+            continue
+          # The random sampling is always done here, in channel order, so
+          # that a concurrent run draws the same days and hours as a
+          # sequential one with the same seed. Shards draw from a generator
+          # per channel instead, as they do not see the channels of the others
+          rng = channel_random(shard_seed, y, cha.network, cha.station, cha.channel) \
+                if args.shard is not None else random
+          if args.sampling == 'adaptive':
+            # Windows are drawn from all hours of the epoch, in the order
+            # they are probed, up to the maximum per channel
+            windows = [(w // 24 + 1, w % 24) for w in
+                       rng.sample(range(totaldays * 24), min(args.max_windows, totaldays * 24))]
+          else:
+            days = rng.sample(range(1, totaldays+1), args.days)
+            hours = rng.sample(range(0, 24),
+                               args.hours) # create random set of hours and days for download test
+            windows = [(day, hour) for day in days for hour in hours]
+          # Channels finished in an earlier run are skipped after the
+          # sampling, so the following channels draw the same days and hours
+          if (node, y, cha.network, cha.station, cha.channel) in log.done:
+            print('%d/%d; Already done; %d %s %s %s'
+                  % (curchannel, totchannels, y, cha.network, cha.station, cha.channel))
+            continue
+          # Channels are probed in groups, which share their bulk requests
+          key = group_key(args, cha.network, cha.station, cha.channel)
+          if group and key != groupkey:
+            submit_group(executor, limiter, futures, rsClient, wfc, responses, log, args, node, y, group)
+            group = []
+          groupkey = key
+          group.append(Probe(cha.network, cha.station, cha.channel, realstart, realend,
+                             windows, curchannel, totchannels,
+                             (cha.start_date, cha.end_date)))
+        if group:
+          submit_group(executor, limiter, futures, rsClient, wfc, responses, log, args, node, y, group)
+        for future in futures:
+          future.result()
+        if executor is not None:
+          executor.shutdown()
       except Exception as e:
        print('No Stations available at node: '+node)
        print(e)
+  inventory.save()
+  log.close()
+  if args.transport == 'async':
+    sessions.close()
+    if parse_pool is not None:
+      parse_pool.shutdown()
+  health.summary()
+  # The metrics are written next to the results, with a name that is not
+  # picked up as a result file by plot_result.py
+  metrics_filename = os.path.join(os.path.dirname(args.output_filename),
+                                  'metrics_' + os.path.basename(args.output_filename))
+  metrics.write_json(metrics_filename)
+  if args.prometheus_filename is not None:
+    metrics.write_prometheus(args.prometheus_filename)
+  if responses is not None:
+    responses.close()
+  # The channel results are only kept in the log, the final file is built from it
+  results = build_results(results, read_result_log(log.filename))
   with open(args.output_filename,'w') as output:
     json.dump(results, output)
+  if args.shard is not None:
+    write_manifest(args.output_filename, args.shard, shard_seed, assigned)
 
 if __name__ == '__main__':
   main()
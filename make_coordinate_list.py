@@ -2,22 +2,82 @@ import os
 import json
 import argparse
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from obspy.clients.fdsn import Client
 from obspy.clients.fdsn import RoutingClient
+from obspy.clients.fdsn.header import FDSNNoDataException
 from obspy import UTCDateTime
+from channel_inventory import ChannelInventory
+from channel_inventory import CHANNELS
 
-def append_dictionary(station_dictionary, inv):
+def append_dictionary(station_dictionary, inv, replace=False):
   for network in inv:
     if network.code not in station_dictionary:
       station_dictionary[network.code] = {}
     for station in network:
-      if station.code not in station_dictionary[network.code]:
+      if replace or station.code not in station_dictionary[network.code]:
         station_dictionary[network.code][station.code] = {
           "latitude" : station.latitude,
           "longitude" : station.longitude,
           "elevation" : station.elevation,
         }
 
+def append_index(station_dictionary, index, replace=False):
+  # Same as append_dictionary, for the stations of a shared channel inventory
+  for net, sta, latitude, longitude, elevation in index.stations():
+    if net not in station_dictionary:
+      station_dictionary[net] = {}
+    if replace or sta not in station_dictionary[net]:
+      station_dictionary[net][sta] = {
+        "latitude" : latitude,
+        "longitude" : longitude,
+        "elevation" : elevation,
+      }
+
+def download_inventory(args, node, start_year, end_year, updatedafter=None, level='station'):
+  print("Initializing "+node+" client.")
+  token = args.authentication
+  try:
+    if args.eida_routing:
+      rsClient = RoutingClient("eida-routing",timeout=args.timeout,credentials={'EIDA_TOKEN': token})
+    else:
+      rsClient = Client(base_url=node,timeout=args.timeout,eida_token=token)
+  except:
+    print("*!!!* Failed to initialize client with eida token, proceeding without authentication. *!!!*")
+    if args.eida_routing:
+      rsClient = RoutingClient("eida-routing",timeout=args.timeout)
+    else:
+      rsClient = Client(base_url=node,timeout=args.timeout)
+  if updatedafter is None:
+    print('Downloading station inventory from %s...' % node)
+  else:
+    print('Downloading stations of %s updated after %s...' % (node, updatedafter))
+  kwargs = {} if updatedafter is None else {'updatedafter': UTCDateTime(updatedafter)}
+  try:
+    return rsClient.get_stations(
+      channel = CHANNELS,
+      starttime = start_year,
+      endtime = end_year,
+      level = level,
+      includerestricted = False,
+      **kwargs
+    )
+  except FDSNNoDataException:
+    # Nothing changed since the last update
+    return []
+
+def read_json(filename):
+  if not os.path.exists(filename):
+    return {}
+  with open(filename) as infile:
+    return json.load(infile)
+
+def write_json(filename, data):
+  # Written to a temporary file first, so an interrupted run keeps the old file
+  with open(filename + '.tmp', 'w') as outfile:
+    json.dump(data, outfile)
+  os.replace(filename + '.tmp', filename)
+
 def main():
   sy = datetime.datetime.now().year - 1
   ey = sy
@@ -29,44 +89,82 @@ def main():
                       help='Year to end the test (default=last year).')
   parser.add_argument('-r', '--eida_routing', default=True, type=bool,
                       help='Switch to choose between eida routing and individual node clients (default=True).')
+  parser.add_argument('-n', '--nodes', default=None, type=str,
+                      help='List of comma-separated FDSN nodes to query with individual clients instead of the EIDA nodes (default=None).')
   parser.add_argument('-a', '--authentication', default=os.path.expanduser('~/.eidatoken'),
                       help='File containing the token to use during the authentication process (default=~/.eidatoken).')
   parser.add_argument('-t', '--timeout', default=30, type=int,
                       help='Number of seconds to be used as a timeout for the HTTP calls (default=30).')
+  parser.add_argument('-o', '--output_filename', default="coordinates.json", type=str,
+                      help='File to write the station coordinates to (default="coordinates.json").')
+  parser.add_argument('-i', '--incremental', action='store_true',
+                      help='Only query the stations updated since the last run and merge them into the existing file.')
+  parser.add_argument('-w', '--workers', default=None, type=int,
+                      help='Number of nodes queried in parallel (default=all nodes).')
+  parser.add_argument('--inventory', default=None, type=str,
+                      help='JSON file with the channels discovered by check_retrievability.py to take the coordinates from (default=None).')
+  parser.add_argument('--inventory_max_age', default=24, type=float,
+                      help='Number of hours after which the stored channels are discovered again (default=24).')
   args = parser.parse_args()
-  token = args.authentication
   start_year = UTCDateTime(args.start,1,1)
   end_year = UTCDateTime(args.end,12,31)
-  if args.eida_routing:
+  if args.nodes is not None:
+    # Explicitly given nodes are always queried with individual clients
+    args.eida_routing = False
+    eida_nodes = list(map(str.strip, args.nodes.split(',')))
+  elif args.eida_routing:
     eida_nodes = ["eida-routing"]
   else:
     eida_nodes = [ "http://eida.geo.uib.no", "GFZ", "RESIF", "INGV", "ETH", "BGR", "NIEP", "KOERI", "LMU", "NOA", "ICGC", "ODC" ]
-  station_dictionary = {}
-  for node in eida_nodes:
-    print("Initializing "+node+" client.")
-    try:
-      if args.eida_routing:
-        rsClient = RoutingClient("eida-routing",timeout=args.timeout,credentials={'EIDA_TOKEN': token})
-      else:
-        rsClient = Client(base_url=node,timeout=args.timeout,eida_token=token)
-    except:
-      print("*!!!* Failed to initialize client with eida token, proceeding without authentication. *!!!*")
-      if args.eida_routing:
-        rsClient = RoutingClient("eida-routing",timeout=args.timeout)
+  # The time of the last successful query of each node is kept next to the
+  # coordinates, so a failed node is queried for all its changes next time
+  state_filename = args.output_filename + '.updated'
+  if args.incremental:
+    station_dictionary = read_json(args.output_filename)
+    updated = read_json(state_filename)
+  else:
+    station_dictionary = {}
+    updated = {}
+  workers = args.workers if args.workers is not None else len(eida_nodes)
+  # With a shared channel inventory, the coordinates are taken from the
+  # channels discovered for (or by) check_retrievability.py, which are only
+  # fetched again when they are outdated
+  inventory = ChannelInventory(args.inventory, args.inventory_max_age) if args.inventory is not None else None
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = []
+    for node in eida_nodes:
+      queried = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+      if inventory is not None:
+        future = executor.submit(inventory.index, node, start_year, end_year,
+                                 lambda starttime, endtime, node=node:
+                                   download_inventory(args, node, starttime, endtime, level='channel'))
       else:
-        rsClient = Client(base_url=node,timeout=args.timeout)
-    print('Downloading station inventory...')
-    inv = rsClient.get_stations(
-      channel = '*HZ',
-      starttime = start_year,
-      endtime = end_year,
-      level = 'station',
-      includerestricted = False,
-    )
-    append_dictionary(station_dictionary,inv)
-  print('Writing "coordinates.json"...')
-  with open('coordinates.json','w') as outfile:
-    json.dump(station_dictionary,outfile)
+        future = executor.submit(download_inventory, args, node, start_year, end_year,
+                                 updated.get(node) if args.incremental else None)
+      futures.append((node, queried, future))
+    # Merged in the order of the nodes, independent of which answered first
+    for node, queried, future in futures:
+      if inventory is not None:
+        append_index(station_dictionary,future.result(),replace=args.incremental)
+        continue
+      if not args.incremental:
+        append_dictionary(station_dictionary,future.result())
+        updated[node] = queried
+        continue
+      try:
+        inv = future.result()
+      except Exception as e:
+        print('*!!!* Failed to update the stations of %s: %s *!!!*' % (node, e))
+        continue
+      # Changed stations replace their old entries, while stations that are
+      # not in the answer, e.g. closed ones, are kept
+      append_dictionary(station_dictionary,inv,replace=node in updated)
+      updated[node] = queried
+  if inventory is not None:
+    inventory.save()
+  print('Writing "%s"...' % args.output_filename)
+  write_json(args.output_filename, station_dictionary)
+  write_json(state_filename, updated)
   print("Done.")
 
 if __name__ == '__main__':
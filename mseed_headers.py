@@ -0,0 +1,96 @@
+"""Minimal miniSEED 2 record header reader for the coverage checks.
+
+   Only the fixed section of the data header and the blockettes 1000 and
+   1001 are decoded, the samples themselves are never touched.
+"""
+
+import struct
+import calendar
+
+# Record length used when a record has no blockette 1000
+DEFAULT_RECORD_LENGTH = 512
+
+def sample_rate(factor, multiplier):
+  if factor == 0 or multiplier == 0:
+    return 0.0
+  if factor > 0 and multiplier > 0:
+    return float(factor * multiplier)
+  elif factor > 0:
+    return -float(factor) / multiplier
+  elif multiplier > 0:
+    return -float(multiplier) / factor
+  return 1.0 / (factor * multiplier)
+
+def parse_header(record):
+  # Returns (network, station, location, channel, starttime, endtime,
+  # record length), with the times as POSIX timestamps. The endtime is the
+  # time of the last sample, like in obspy.
+  year = struct.unpack('>H', record[20:22])[0]
+  endian = '>' if 1900 <= year <= 2100 else '<'
+  (year, doy, hour, minute, second, _, tenthms, nsamples, factor, multiplier,
+   activity, _, _, nblockettes, correction, _, blockette) = \
+    struct.unpack(endian + 'HHBBBBHHhhBBBBiHH', record[20:48])
+  starttime = (calendar.timegm((year, 1, 1, hour, minute, second)) + (doy - 1) * 86400
+               + tenthms / 10000.0)
+  # Apply the time correction if it was not applied already
+  if not activity & 0x02:
+    starttime += correction / 10000.0
+  length = DEFAULT_RECORD_LENGTH
+  for _ in range(nblockettes):
+    if blockette == 0 or blockette + 4 > len(record):
+      break
+    btype, bnext = struct.unpack(endian + 'HH', record[blockette:blockette+4])
+    if btype == 1000 and blockette + 7 <= len(record):
+      length = 2 ** record[blockette+6]
+    elif btype == 1001 and blockette + 6 <= len(record):
+      starttime += struct.unpack('b', record[blockette+5:blockette+6])[0] / 1000000.0
+    blockette = bnext
+  rate = sample_rate(factor, multiplier)
+  if rate > 0 and nsamples > 0:
+    endtime = starttime + (nsamples - 1) / rate
+  else:
+    endtime = starttime
+  codes = [record[a:b].decode('ascii', 'replace').strip()
+           for a, b in ((18, 20), (8, 13), (13, 15), (15, 18))]
+  return codes + [starttime, endtime, rate, length]
+
+class HeaderReader(object):
+  """Collects the record headers of a miniSEED byte stream fed in chunks."""
+
+  def __init__(self):
+    self.buffer = bytearray()
+    self.records = []
+
+  def feed(self, chunk):
+    self.buffer += chunk
+    # The consumed records are dropped once per chunk, not once per record
+    offset = 0
+    while len(self.buffer) - offset >= 64:
+      net, sta, loc, cha, starttime, endtime, rate, length = \
+        parse_header(bytes(self.buffer[offset:offset+64]))
+      if len(self.buffer) - offset < length:
+        break
+      self.records.append((net, sta, loc, cha, starttime, endtime, rate))
+      offset += length
+    del self.buffer[:offset]
+
+def window_coverage(records, net, sta, cha, start, end, maximum):
+  # Time covered per location code within a window, computed the same way as
+  # from the trimmed traces: contiguous records are joined into traces and
+  # every trace counts with at most the maximum duration
+  segments = {}
+  for rnet, rsta, rloc, rcha, rstart, rend, rate in sorted(records, key=lambda r: r[4]):
+    if (rnet, rsta, rcha) != (net, sta, cha) or rend < start or rstart > end:
+      continue
+    rstart = max(rstart, start)
+    rend = min(rend, end)
+    trace = segments.setdefault(rloc, [])
+    delta = 1.0 / rate if rate > 0 else 0.0
+    if trace and rstart - trace[-1][1] <= 1.5 * delta:
+      trace[-1][1] = max(trace[-1][1], rend)
+    else:
+      trace.append([rstart, rend])
+  coverage = {}
+  for loc, traces in segments.items():
+    coverage[loc] = sum(min(tend - tstart, maximum) for tstart, tend in traces)
+  return coverage
@@ -1,18 +1,94 @@
+import os
 import json
 import argparse
-import glob
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
 from matplotlib.offsetbox import AnchoredText
 from cartopy.io.img_tiles import GoogleTiles
 import cartopy.crs as ccrs
 import numpy as np
+from PIL import Image
+from results_store import ResultsStore
 
-def plot_map(xs,ys,cs,xm,ym,xp,yp,extent,detail,outfile):
-  plt.ioff()
-  tiler = GoogleTiles(style='satellite')
+class CachedTiles(GoogleTiles):
+  """Google tiles with a persistent cache on disk, which can also be used offline."""
+
+  def __init__(self, directory, offline=False, style='satellite'):
+    GoogleTiles.__init__(self, style=style)
+    self.directory = directory
+    self.offline = offline
+
+  def tile_filename(self, tile):
+    x, y, z = tile
+    return os.path.join(self.directory, self.style, str(z), '%d_%d.png' % (x, y))
+
+  def get_image(self, tile):
+    filename = self.tile_filename(tile)
+    if os.path.exists(filename):
+      # Used tiles are touched, so the eviction removes the least recently used
+      os.utime(filename)
+      img = Image.open(filename)
+    elif self.offline:
+      # Tiles that were never seeded stay blank instead of failing the map
+      img = Image.new('RGB', (256, 256))
+    else:
+      img, _, _ = GoogleTiles.get_image(self, tile)
+      os.makedirs(os.path.dirname(filename), exist_ok=True)
+      # Several rendering processes may fetch the same tile
+      tmpfile = '%s.%d.tmp' % (filename, os.getpid())
+      img.save(tmpfile, 'PNG')
+      os.replace(tmpfile, filename)
+    return img.convert(self.desired_tile_form), self.tileextent(tile), 'lower'
+
+def evict_tiles(directory, max_size):
+  # Remove the least recently used tiles until the cache fits into max_size MB
+  tiles = []
+  for root, _, files in os.walk(directory):
+    for name in files:
+      filename = os.path.join(root, name)
+      stat = os.stat(filename)
+      tiles.append((stat.st_mtime, stat.st_size, filename))
+  total = sum(size for _, size, _ in tiles)
+  for _, size, filename in sorted(tiles):
+    if total <= max_size * 1024 * 1024:
+      break
+    os.remove(filename)
+    total -= size
+
+def make_tiler(tile_cache, offline):
+  if tile_cache is None:
+    return GoogleTiles(style='satellite')
+  return CachedTiles(tile_cache, offline)
+
+def new_map(extent):
   fig = plt.figure(figsize=(10, 7.5))
   ax = fig.add_subplot(1, 1, 1, projection=ccrs.Robinson())
+  ax.set_extent(extent, ccrs.PlateCarree())
+  return fig, ax
+
+def basemap_filename(directory, extent, detail):
+  return os.path.join(directory, 'basemap_%s_%d.png' % ('_'.join('%g' % e for e in extent), detail))
+
+def render_basemap(extent, detail, tile_cache, offline, outfile):
+  # Only the projected satellite image of the map area, to draw the scatter
+  # layers on later without fetching and reprojecting the tiles again
+  plt.ioff()
+  fig, ax = new_map(extent)
+  ax.spines['geo'].set_visible(False)
+  ax.add_image(make_tiler(tile_cache, offline), detail, zorder=1)
+  ax.set_extent(extent, ccrs.PlateCarree())
+  fig.canvas.draw()
+  bbox = ax.get_window_extent().transformed(fig.dpi_scale_trans.inverted())
+  os.makedirs(os.path.dirname(os.path.abspath(outfile)), exist_ok=True)
+  tmpfile = '%s.%d.tmp.png' % (outfile, os.getpid())
+  plt.savefig(tmpfile, dpi=400, bbox_inches=bbox, pad_inches=0)
+  plt.close()
+  os.replace(tmpfile, outfile)
+
+def plot_map(xs,ys,cs,xm,ym,xp,yp,extent,detail,outfile,tile_cache=None,offline=False,basemap=None):
+  plt.ioff()
+  fig, ax = new_map(extent)
   N = 128
   vals = np.ones((2*N, 4))
   vals[:, 0] = np.concatenate((np.linspace(255/255, 255/255, N),np.linspace(255/255,   0/255, N)))
@@ -31,12 +107,19 @@ def plot_map(xs,ys,cs,xm,ym,xp,yp,extent,detail,outfile):
              marker='^', c=cs, s=12,
              linewidths=0.12,edgecolor='#000000',
              cmap=newcmp,zorder=3,
-             norm=plt.Normalize(min(cs),max(cs)))
+             norm=plt.Normalize(min(cs, default=0),max(cs, default=100)))
   ax.legend(loc='upper left',bbox_to_anchor=(0.0,0.005),
             framealpha=1.0,facecolor='#060606',
             labelcolor='#f1f1f1',edgecolor='#060606')
-  ax.add_image(tiler, detail,zorder=1)
-  ax.set_extent(extent, ccrs.PlateCarree())
+  if basemap is None:
+    ax.add_image(make_tiler(tile_cache, offline), detail,zorder=1)
+    ax.set_extent(extent, ccrs.PlateCarree())
+  else:
+    # The basemap is already in the map projection and covers the map extent
+    ax.set_extent(extent, ccrs.PlateCarree())
+    ax.imshow(plt.imread(basemap), extent=ax.get_extent(), transform=ax.projection,
+              origin='upper', zorder=1)
+    ax.set_extent(extent, ccrs.PlateCarree())
   text = AnchoredText('Images \u00A9 2023 TerraMetrics, Map Data \u00A9 2023 Google',
                       loc=4, prop={'size': 6}, frameon=False, alpha=0.5)
   ax.add_artist(text)
@@ -45,17 +128,26 @@ def plot_map(xs,ys,cs,xm,ym,xp,yp,extent,detail,outfile):
   plt.savefig(outfile,dpi=400,bbox_inches="tight")
   plt.close()
 
-def inv_recurse(total,key,item):
-  if type(item) is dict:
-    if not key in total:
-      total[key] = {}
-    for rkey,ritem in item.items():
-      inv_recurse(total[key],rkey,ritem)
-  else:
-    if not key in total:
-      total[key] = [min([1.0,item])]
-    else:
-      total[key].append(min([1.0,item]))
+def load_coordinates(coords):
+  # Coordinates as arrays sorted by station key, for vectorized joins
+  keys = []
+  lons = []
+  lats = []
+  for netkey, netval in coords.items():
+    for stakey, staval in netval.items():
+      keys.append(netkey + '.' + stakey)
+      lons.append(staval['longitude'])
+      lats.append(staval['latitude'])
+  keys = np.array(keys, dtype='U16')
+  order = np.argsort(keys)
+  return keys[order], np.array(lons)[order], np.array(lats)[order]
+
+def join_coordinates(stations, keys, lons, lats):
+  if len(keys) == 0:
+    return np.zeros(len(stations), dtype=bool), np.empty(0), np.empty(0)
+  pos = np.minimum(np.searchsorted(keys, stations), len(keys) - 1)
+  found = keys[pos] == stations
+  return found, lons[pos[found]], lats[pos[found]]
 
 def main():
   desc = 'Script to plot station maps for the results of the EIDA data retrievability tests.'
@@ -69,53 +161,84 @@ def main():
   parser.add_argument('-r', '--results_directory', default=".", type=str,
                       help='Directory with the result files (default=".").')
   parser.add_argument('-t', '--type', default='ret', type=str,
-                      help='Type of the result to plot (actual retrievability (ret) or waveform catalogue info (wfc)) (default=ret).')
+                      help='Comma-separated types of the result to plot (actual retrievability (ret) or waveform catalogue info (wfc)) (default=ret).')
+  parser.add_argument('-a', '--aggregate', default='mean', choices=['mean', 'min', 'latest'],
+                      help='How to combine the results of a station from all result files (default=mean).')
+  parser.add_argument('-d', '--database', default=None, type=str,
+                      help='SQLite results store to ingest the result files into (default=results.sqlite in the results directory).')
+  parser.add_argument('--per_network', action='store_true',
+                      help='Also plot a map of the area of each network.')
+  parser.add_argument('-w', '--workers', default=2, type=int,
+                      help='Number of processes rendering the maps in parallel (default=2).')
+  parser.add_argument('--tile_cache', default=None, type=str,
+                      help='Directory to cache the satellite tiles in between runs (default=None).')
+  parser.add_argument('--tile_cache_size', default=500, type=int,
+                      help='Maximum size of the tile cache in MB (default=500).')
+  parser.add_argument('--offline', action='store_true',
+                      help='Only use tiles from the tile cache, leaving missing tiles blank.')
+  parser.add_argument('--basemap_directory', default=None, type=str,
+                      help='Directory with pre-rendered basemaps to draw the stations on, rendered when missing (default=None).')
   args = parser.parse_args()
-  print('Plotting %s map...' % 'retrievability' if args.type == 'ret' else 'waveform catalogue')
+  types = args.type.split(',')
   with open(args.coords_filename) as coordsfile:
     coords = json.load(coordsfile)
-  results = []
-  for _,infile in enumerate(glob.glob(args.results_directory+'/results*.json')):
-    with open(infile) as jsonfile:
-      results.append(json.load(jsonfile))
-  comb = {}
-  for result in results:
-    for nodekey,nodeval in result.items():
-      inv_recurse(comb,nodekey,nodeval)
-  xs = []
-  ys = []
-  cs = []
-  xp = []
-  yp = []
-  key = 'percentage' if args.type == 'ret' else 'days_with_metrics'
-  for _,nodeval in comb.items():
-    for _,yearval in nodeval.items():
-      for netkey,netval in yearval.items():
-        for stakey,staval in netval.items():
-          for _,chaval in staval.items():
-            for finkey,finval in chaval.items():
-              if netkey in coords:
-                if stakey in coords[netkey]:
-                  if finkey == key:
-                    xs.append(coords[netkey][stakey]['longitude'])
-                    ys.append(coords[netkey][stakey]['latitude'])
-                    cs.append(sum(finval)/len(results)*100)
-                  elif finkey == 'metadata_problem' and all(finval):
-                    xp.append(coords[netkey][stakey]['longitude'])
-                    yp.append(coords[netkey][stakey]['latitude'])
-                else:
-                  print('Failed to find coordinate information for %s %s.' % (netkey,stakey))
-              else:
-                print('Failed to find coordinate information for %s.' % (netkey))
-  xm = []
-  ym = []
-  for netkey,netval in coords.items():
-    for stakey,staval in netval.items():
-      xm.append(staval['longitude'])
-      ym.append(staval['latitude'])
-  plot_map(xs,ys,cs,xm,ym,xp,yp,[-20, 46, 27.4, 76],7,args.output_filename+'_europe.png')
-  if args.global_overview_map:
-    plot_map(xs,ys,cs,xm,ym,xp,yp,[-180, 180, -90, 90],5,args.output_filename+'_global.png')
+  # New result files are ingested into the store once, which keeps running
+  # aggregates per station, so plotting does not re-read the older runs
+  store = ResultsStore(args.database if args.database is not None
+                       else os.path.join(args.results_directory, 'results.sqlite'))
+  store.ingest_directory(args.results_directory)
+  keys, lons, lats = load_coordinates(coords)
+  maps = []
+  for maptype in types:
+    print('Plotting %s map...' % ('retrievability' if maptype == 'ret' else 'waveform catalogue'))
+    maptype = 'ret' if maptype == 'ret' else 'wfc'
+    rows = store.station_values(maptype, args.aggregate)
+    stations = np.array([net + '.' + sta for net, sta, _ in rows], dtype='U16')
+    values = np.array([value for _, _, value in rows], dtype=float)
+    problems = np.array([net + '.' + sta for net, sta in store.problem_stations(maptype)], dtype='U16')
+    found, xs, ys = join_coordinates(stations, keys, lons, lats)
+    cs = values[found] * 100
+    for station in stations[~found]:
+      print('Failed to find coordinate information for %s.' % station.replace('.', ' '))
+    pfound, xp, yp = join_coordinates(problems, keys, lons, lats)
+    prefix = args.output_filename if len(types) == 1 else args.output_filename + '_' + maptype
+    maps.append((xs,ys,cs,lons,lats,xp,yp,[-20, 46, 27.4, 76],7,prefix+'_europe.png'))
+    if args.global_overview_map:
+      maps.append((xs,ys,cs,lons,lats,xp,yp,[-180, 180, -90, 90],5,prefix+'_global.png'))
+    if args.per_network:
+      measured = stations[found]
+      for net in np.unique(np.char.partition(keys, '.')[:, 0]):
+        inside = np.char.startswith(keys, net + '.')
+        selected = np.char.startswith(measured, net + '.')
+        chosen = np.char.startswith(problems[pfound], net + '.')
+        # The network area with a margin around its stations
+        extent = [max(-180, lons[inside].min() - 2), min(180, lons[inside].max() + 2),
+                  max(-90, lats[inside].min() - 2), min(90, lats[inside].max() + 2)]
+        maps.append((xs[selected],ys[selected],cs[selected],lons[inside],lats[inside],
+                     xp[chosen],yp[chosen],extent,7,prefix+'_'+net+'.png'))
+  store.close()
+  with ProcessPoolExecutor(max_workers=args.workers) as executor:
+    basemaps = {}
+    if args.basemap_directory is not None:
+      # Basemaps are shared by all maps with the same area and only rendered
+      # when they do not exist yet
+      for amap in maps:
+        extent, detail = amap[7], amap[8]
+        filename = basemap_filename(args.basemap_directory, extent, detail)
+        basemaps[(tuple(extent), detail)] = filename
+      pending = [executor.submit(render_basemap, list(extent), detail, args.tile_cache,
+                                 args.offline, filename)
+                 for (extent, detail), filename in basemaps.items()
+                 if not os.path.exists(filename)]
+      for future in pending:
+        future.result()
+    futures = [executor.submit(plot_map, *amap, tile_cache=args.tile_cache, offline=args.offline,
+                               basemap=basemaps.get((tuple(amap[7]), amap[8])))
+               for amap in maps]
+    for future in futures:
+      future.result()
+  if args.tile_cache is not None:
+    evict_tiles(args.tile_cache, args.tile_cache_size)
   print('DONE!')
 
 if __name__ == '__main__':
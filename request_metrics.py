@@ -0,0 +1,109 @@
+"""Latency and throughput statistics of the requests made by check_retrievability.py.
+
+   The statistics are aggregated per node and service into latency
+   histograms, and can be written as JSON or as a Prometheus textfile.
+"""
+
+import os
+import json
+import threading
+
+# Upper bounds of the latency histogram buckets in seconds
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+
+class RequestMetrics(object):
+  """Thread-safe collection of request statistics per node and service."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.stats = {}
+
+  def entry(self, node, service):
+    key = (node, service)
+    if key not in self.stats:
+      self.stats[key] = {'count': 0, 'latency_sum': 0.0, 'buckets': [0] * (len(BUCKETS) + 1),
+                         'bytes': 0, 'status': {}, 'retries': 0}
+    return self.stats[key]
+
+  def observe(self, node, service, latency, status):
+    # A latency of None only counts the status, e.g. for skipped calls
+    with self.lock:
+      stats = self.entry(node, service)
+      stats['status'][status] = stats['status'].get(status, 0) + 1
+      if latency is None:
+        return
+      stats['count'] += 1
+      stats['latency_sum'] += latency
+      for i, bound in enumerate(BUCKETS):
+        if latency <= bound:
+          stats['buckets'][i] += 1
+          break
+      else:
+        stats['buckets'][-1] += 1
+
+  def received(self, node, service, nbytes):
+    with self.lock:
+      self.entry(node, service)['bytes'] += nbytes
+
+  def retry(self, node, service, count=1):
+    with self.lock:
+      self.entry(node, service)['retries'] += count
+
+  def to_dict(self):
+    metrics = {}
+    with self.lock:
+      for (node, service), stats in sorted(self.stats.items()):
+        buckets = {}
+        total = 0
+        for bound, count in zip(BUCKETS + ['+Inf'], stats['buckets']):
+          total += count
+          buckets[str(bound)] = total
+        metrics.setdefault(node, {})[service] = {
+          'count': stats['count'],
+          'latency_sum': stats['latency_sum'],
+          'latency_mean': stats['latency_sum'] / stats['count'] if stats['count'] else 0.0,
+          'latency_buckets': buckets,
+          'bytes': stats['bytes'],
+          'bytes_per_second': stats['bytes'] / stats['latency_sum'] if stats['latency_sum'] else 0.0,
+          'status': dict(stats['status']),
+          'retries': stats['retries'],
+        }
+    return metrics
+
+  def write_json(self, filename):
+    with open(filename, 'w') as outfile:
+      json.dump(self.to_dict(), outfile, indent=1)
+
+  def write_prometheus(self, filename):
+    lines = ['# HELP eida_request_duration_seconds Latency of the requests to the EIDA services.',
+             '# TYPE eida_request_duration_seconds histogram']
+    metrics = self.to_dict()
+    for node, services in metrics.items():
+      for service, stats in services.items():
+        labels = 'node="%s",service="%s"' % (node, service)
+        for bound, count in stats['latency_buckets'].items():
+          lines.append('eida_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, count))
+        lines.append('eida_request_duration_seconds_sum{%s} %f' % (labels, stats['latency_sum']))
+        lines.append('eida_request_duration_seconds_count{%s} %d' % (labels, stats['count']))
+    lines += ['# HELP eida_request_bytes_total Bytes received from the EIDA services.',
+              '# TYPE eida_request_bytes_total counter']
+    for node, services in metrics.items():
+      for service, stats in services.items():
+        lines.append('eida_request_bytes_total{node="%s",service="%s"} %d' % (node, service, stats['bytes']))
+    lines += ['# HELP eida_requests_total Requests to the EIDA services by status.',
+              '# TYPE eida_requests_total counter']
+    for node, services in metrics.items():
+      for service, stats in services.items():
+        for status, count in sorted(stats['status'].items()):
+          lines.append('eida_requests_total{node="%s",service="%s",status="%s"} %d'
+                       % (node, service, status, count))
+    lines += ['# HELP eida_request_retries_total Requests repeated after a failed bulk request.',
+              '# TYPE eida_request_retries_total counter']
+    for node, services in metrics.items():
+      for service, stats in services.items():
+        lines.append('eida_request_retries_total{node="%s",service="%s"} %d' % (node, service, stats['retries']))
+    # Write to a temporary file first, so the textfile collector never
+    # reads a partial file
+    with open(filename + '.tmp', 'w') as outfile:
+      outfile.write('\n'.join(lines) + '\n')
+    os.replace(filename + '.tmp', filename)
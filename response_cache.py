@@ -0,0 +1,153 @@
+"""On-disk cache of the StationXML response metadata used by check_retrievability.py.
+
+   Entries are kept per network, station, channel code and channel epoch, so
+   they can be shared between channels, years and runs.
+"""
+
+import os
+import json
+import time
+import threading
+from obspy import read_inventory
+from obspy import UTCDateTime
+from obspy.clients.fdsn.header import FDSNNoDataException
+
+class ResponseCache(object):
+  """Size-bounded LRU cache of response level inventories on disk."""
+
+  def __init__(self, directory, max_size=500):
+    self.directory = directory
+    # Maximum size of the cache in MB
+    self.max_size = max_size * 1024 * 1024
+    self.lock = threading.Lock()
+    os.makedirs(directory, exist_ok=True)
+    self.index_filename = os.path.join(directory, 'index.json')
+    if os.path.exists(self.index_filename):
+      with open(self.index_filename) as infile:
+        self.index = json.load(infile)
+    else:
+      self.index = {'checked': None, 'entries': {}}
+    # Changes are checked relative to the start of the previous run
+    self.previous_check = self.index['checked']
+    self.index['checked'] = str(UTCDateTime())
+
+  def key(self, net, sta, cha, epoch):
+    start, end = epoch
+    return '%s.%s.%s.%s.%s' % (net, sta, cha, UTCDateTime(start).strftime('%Y%m%dT%H%M%S'),
+                               UTCDateTime(end).strftime('%Y%m%dT%H%M%S') if end is not None else 'open')
+
+  def filename(self, key):
+    return os.path.join(self.directory, key + '.xml')
+
+  def save_index(self):
+    tmpfile = self.index_filename + '.tmp'
+    with open(tmpfile, 'w') as outfile:
+      json.dump(self.index, outfile)
+    os.replace(tmpfile, self.index_filename)
+
+  def get(self, client, net, sta, cha, epoch):
+    key = self.key(net, sta, cha, epoch)
+    with self.lock:
+      entry = self.index['entries'].get(key)
+      if entry is not None:
+        entry['used'] = time.time()
+    if entry is not None:
+      try:
+        return read_inventory(self.filename(key), format='STATIONXML')
+      except Exception:
+        # The file vanished or is broken, drop the entry so it is downloaded
+        # again
+        with self.lock:
+          if key in self.index['entries']:
+            self.remove(key)
+            self.save_index()
+    self.prefetch(client, [(net, sta, cha, epoch)])
+    return read_inventory(self.filename(key), format='STATIONXML')
+
+  def missing(self, channels):
+    with self.lock:
+      return [(net, sta, cha, epoch) for net, sta, cha, epoch in channels
+              if self.key(net, sta, cha, epoch) not in self.index['entries']]
+
+  def query(self, missing):
+    # Arguments of the station request for the responses of the channels
+    starttime = min(UTCDateTime(epoch[0]) for _, _, _, epoch in missing)
+    endtimes = [epoch[1] for _, _, _, epoch in missing]
+    return dict(network=','.join(sorted(set(c[0] for c in missing))),
+                station=','.join(sorted(set(c[1] for c in missing))),
+                channel=','.join(sorted(set(c[2] for c in missing))),
+                starttime=starttime,
+                endtime=None if None in endtimes else max(endtimes),
+                level='response')
+
+  def prefetch(self, client, channels):
+    # Download the responses of several channels of a station or network with
+    # a single request and slice the per channel inventories out of it
+    missing = self.missing(channels)
+    if len(missing) == 0:
+      return
+    inventory = client.get_stations(**self.query(missing))
+    for net, sta, cha, epoch in missing:
+      part = inventory.select(network=net, station=sta, channel=cha,
+                              starttime=epoch[0], endtime=epoch[1])
+      if len(part.get_contents()['channels']) == 0:
+        continue
+      self.put(self.key(net, sta, cha, epoch), '%s.%s.%s' % (net, sta, cha), part)
+
+  def put(self, key, channel, inventory):
+    filename = self.filename(key)
+    inventory.write(filename + '.tmp', format='STATIONXML')
+    os.replace(filename + '.tmp', filename)
+    with self.lock:
+      self.index['entries'][key] = {'channel': channel, 'size': os.path.getsize(filename),
+                                    'used': time.time()}
+      self.evict()
+      self.save_index()
+
+  def remove(self, key):
+    del self.index['entries'][key]
+    try:
+      os.remove(self.filename(key))
+    except OSError:
+      pass
+
+  def evict(self):
+    # Remove the least recently used entries until the cache fits its size
+    entries = self.index['entries']
+    total = sum(entry['size'] for entry in entries.values())
+    for key in sorted(entries, key=lambda k: entries[k]['used']):
+      if total <= self.max_size:
+        break
+      total -= entries[key]['size']
+      self.remove(key)
+
+  def invalidate_updated(self, client):
+    # Drop all entries of channels whose metadata changed since the last run
+    if self.previous_check is None:
+      return
+    try:
+      updated = client.get_stations(level='channel', channel='BHZ,HHZ',
+                                    updatedafter=UTCDateTime(self.previous_check))
+    except FDSNNoDataException:
+      updated = []
+    except Exception as e:
+      print('Failed to check for updated responses: %s' % e)
+      # Check again from the same time during the next run
+      self.index['checked'] = self.previous_check
+      return
+    changed = set()
+    for net in updated:
+      for sta in net:
+        for cha in sta:
+          changed.add('%s.%s.%s' % (net.code, sta.code, cha.code))
+    with self.lock:
+      removed = [key for key, entry in self.index['entries'].items()
+                 if entry['channel'] in changed]
+      for key in removed:
+        self.remove(key)
+      self.save_index()
+    print('%d cached responses invalidated' % len(removed))
+
+  def close(self):
+    with self.lock:
+      self.save_index()
@@ -0,0 +1,282 @@
+"""Indexed SQLite store of the results of check_retrievability.py.
+
+   Every result file is ingested once (tracked by its hash) into one row per
+   node/year/net/sta/cha/run. Running aggregates per station are updated
+   during the ingest, so reading them does not depend on the number of runs.
+"""
+
+import os
+import glob
+import json
+import sqlite3
+import hashlib
+import argparse
+import datetime
+import numpy as np
+from sharding import manifest_filename
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY,
+  hash TEXT UNIQUE,
+  filename TEXT,
+  time REAL,
+  size INTEGER,
+  mtime REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+  run INTEGER REFERENCES runs(id),
+  node TEXT,
+  year INTEGER,
+  network TEXT,
+  station TEXT,
+  channel TEXT,
+  percentage REAL,
+  days_with_metrics INTEGER,
+  metadata_problem INTEGER,
+  status TEXT,
+  PRIMARY KEY (run, node, year, network, station, channel)
+);
+CREATE INDEX IF NOT EXISTS results_station ON results (network, station);
+CREATE INDEX IF NOT EXISTS results_node ON results (node);
+CREATE INDEX IF NOT EXISTS runs_time ON runs (time);
+CREATE TABLE IF NOT EXISTS stations (
+  network TEXT,
+  station TEXT,
+  type TEXT,
+  sum REAL,
+  count INTEGER,
+  min REAL,
+  latest REAL,
+  latest_time REAL,
+  problems INTEGER,
+  checks INTEGER,
+  PRIMARY KEY (network, station, type)
+);
+'''
+
+# Result keys of the two map types of plot_result.py
+TYPES = {'ret': 'percentage', 'wfc': 'days_with_metrics'}
+
+def flatten_results(result, key):
+  # Flatten the nested node/year/net/sta/cha layout of one result file into
+  # a table with one row per channel
+  rows = []
+  for nodeval in result.values():
+    for yearval in nodeval.values():
+      for netkey, netval in yearval.items():
+        for stakey, staval in netval.items():
+          for chaval in staval.values():
+            if key not in chaval and 'metadata_problem' not in chaval:
+              continue
+            value = min(1.0, chaval[key]) if key in chaval else np.nan
+            rows.append((netkey + '.' + stakey, value,
+                         bool(chaval.get('metadata_problem', False)),
+                         'metadata_problem' in chaval))
+  return np.array(rows, dtype=[('station', 'U16'), ('value', 'f8'),
+                               ('problem', '?'), ('checked', '?')])
+
+def station_totals(table):
+  # Sum, count and minimum of the values and the number of metadata
+  # problems and checks per station of one flattened result file
+  stations, inverse = np.unique(table['station'], return_inverse=True)
+  valid = ~np.isnan(table['value'])
+  counts = np.bincount(inverse[valid], minlength=len(stations))
+  sums = np.bincount(inverse[valid], weights=table['value'][valid], minlength=len(stations))
+  minimums = np.full(len(stations), np.inf)
+  np.minimum.at(minimums, inverse[valid], table['value'][valid])
+  checked = table['checked']
+  problems = np.bincount(inverse[checked], weights=table['problem'][checked].astype(float),
+                         minlength=len(stations)).astype(np.int64)
+  checks = np.bincount(inverse[checked], minlength=len(stations))
+  return stations, sums, counts, minimums, problems, checks
+
+def file_hash(filename):
+  sha = hashlib.sha256()
+  with open(filename, 'rb') as infile:
+    for block in iter(lambda: infile.read(1024*1024), b''):
+      sha.update(block)
+  return sha.hexdigest()
+
+class ResultsStore(object):
+  """Results of all runs, with indexed queries and per-station aggregates."""
+
+  def __init__(self, filename):
+    self.db = sqlite3.connect(filename)
+    self.db.executescript(SCHEMA)
+    # Stores created before the file sizes and times were kept
+    columns = [row[1] for row in self.db.execute('PRAGMA table_info(runs)')]
+    with self.db:
+      for column, kind in (('size', 'INTEGER'), ('mtime', 'REAL')):
+        if column not in columns:
+          self.db.execute('ALTER TABLE runs ADD COLUMN %s %s' % (column, kind))
+      self.db.execute('CREATE INDEX IF NOT EXISTS runs_file ON runs (filename, size, mtime)')
+
+  def close(self):
+    self.db.close()
+
+  def ingest_directory(self, directory):
+    ingested = 0
+    for filename in sorted(glob.glob(directory+'/results*.json'), key=os.path.getmtime):
+      # The results of a shard are ingested with the merged results of all
+      # shards, so they are not counted twice
+      if os.path.exists(manifest_filename(filename)):
+        continue
+      ingested += self.ingest(filename)
+    return ingested
+
+  def ingest(self, filename):
+    # Returns 1 if the file was new, 0 if it was ingested before. Only new
+    # or changed files are hashed.
+    name = os.path.basename(filename)
+    stat = os.stat(filename)
+    if self.db.execute('SELECT 1 FROM runs WHERE filename = ? AND size = ? AND mtime = ?',
+                       (name, stat.st_size, stat.st_mtime)).fetchone():
+      return 0
+    digest = file_hash(filename)
+    if self.db.execute('SELECT 1 FROM runs WHERE hash = ?', (digest,)).fetchone():
+      # Same content, e.g. touched or ingested before the file times were
+      # kept, remember the file so it is not hashed again
+      with self.db:
+        self.db.execute('UPDATE runs SET size = ?, mtime = ? WHERE hash = ? AND filename = ?',
+                        (stat.st_size, stat.st_mtime, digest, name))
+      return 0
+    with open(filename) as infile:
+      result = json.load(infile)
+    runtime = stat.st_mtime
+    with self.db:
+      run = self.db.execute('INSERT INTO runs (hash, filename, time, size, mtime) VALUES (?, ?, ?, ?, ?)',
+                            (digest, name, runtime, stat.st_size, stat.st_mtime)).lastrowid
+      rows = []
+      for node, nodeval in result.items():
+        for year, yearval in nodeval.items():
+          for net, netval in yearval.items():
+            for sta, staval in netval.items():
+              for cha, chaval in staval.items():
+                if not chaval:
+                  continue
+                rows.append((run, node, int(year), net, sta, cha, chaval.get('percentage'),
+                             chaval.get('days_with_metrics'), chaval.get('metadata_problem'),
+                             chaval.get('status', 'ok')))
+      self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+      self.update_stations(result, runtime)
+    return 1
+
+  def update_stations(self, result, runtime):
+    # Fold the channels of one run into the running aggregates per station
+    for maptype, key in TYPES.items():
+      runstats = []
+      totals = station_totals(flatten_results(result, key))
+      for station, total, count, minimum, problems, checks in zip(*totals):
+        net, sta = station.split('.', 1)
+        latest = float(total) / count if count else None
+        runstats.append((net, sta, maptype, float(total), int(count),
+                         float(minimum) if count else None, latest,
+                         runtime if latest is not None else None, int(problems), int(checks)))
+      self.db.executemany('''
+          INSERT INTO stations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+          ON CONFLICT (network, station, type) DO UPDATE SET
+            sum = sum + excluded.sum,
+            count = count + excluded.count,
+            min = CASE WHEN min IS NULL THEN excluded.min
+                       WHEN excluded.min IS NULL THEN min
+                       ELSE MIN(min, excluded.min) END,
+            latest = CASE WHEN excluded.latest IS NOT NULL AND
+                               (latest_time IS NULL OR excluded.latest_time >= latest_time)
+                          THEN excluded.latest ELSE latest END,
+            latest_time = CASE WHEN excluded.latest IS NOT NULL AND
+                                    (latest_time IS NULL OR excluded.latest_time >= latest_time)
+                               THEN excluded.latest_time ELSE latest_time END,
+            problems = problems + excluded.problems,
+            checks = checks + excluded.checks''', runstats)
+
+  def station_values(self, maptype, method):
+    # Returns (network, station, value) for all stations with results
+    if method == 'min':
+      expression = 'min'
+    elif method == 'latest':
+      expression = 'latest'
+    else:
+      # Count-aware mean over the results actually present
+      expression = 'sum / count'
+    return self.db.execute('SELECT network, station, %s FROM stations WHERE type = ? AND count > 0'
+                           % expression, (maptype,)).fetchall()
+
+  def problem_stations(self, maptype):
+    return self.db.execute('SELECT network, station FROM stations '
+                           'WHERE type = ? AND checks > 0 AND problems = checks',
+                           (maptype,)).fetchall()
+
+  def query(self, network=None, station=None, node=None, start=None, end=None):
+    # Rows of all matching channel results, with the time of their run
+    conditions = []
+    params = []
+    for column, value in (('results.network', network), ('results.station', station),
+                          ('results.node', node)):
+      if value is not None:
+        conditions.append('%s = ?' % column)
+        params.append(value)
+    if start is not None:
+      conditions.append('runs.time >= ?')
+      params.append(start)
+    if end is not None:
+      conditions.append('runs.time < ?')
+      params.append(end)
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    return self.db.execute('SELECT runs.time, results.node, results.year, results.network, '
+                           'results.station, results.channel, results.percentage, '
+                           'results.days_with_metrics, results.metadata_problem, results.status '
+                           'FROM results JOIN runs ON results.run = runs.id %s '
+                           'ORDER BY runs.time' % where, params).fetchall()
+
+  def monthly(self, network=None, station=None, node=None, start=None, end=None):
+    # Mean retrievability and WFCatalog coverage per month of the runs
+    rows = {}
+    for runtime, _, _, _, _, _, percentage, days, _, _ in self.query(network, station, node,
+                                                                      start, end):
+      month = datetime.datetime.fromtimestamp(runtime, datetime.timezone.utc).strftime('%Y-%m')
+      stats = rows.setdefault(month, [0.0, 0, 0.0, 0])
+      if percentage is not None:
+        stats[0] += min(1.0, percentage)
+        stats[1] += 1
+      if days is not None:
+        stats[2] += min(1.0, days)
+        stats[3] += 1
+    return [(month, stats[0] / stats[1] if stats[1] else None,
+             stats[2] / stats[3] if stats[3] else None, stats[1])
+            for month, stats in sorted(rows.items())]
+
+def timestamp(date):
+  return datetime.datetime.strptime(date, '%Y-%m-%d').replace(
+    tzinfo=datetime.timezone.utc).timestamp() if date is not None else None
+
+def main():
+  desc = 'Script to ingest result files into an indexed store and query their history.'
+  parser = argparse.ArgumentParser(description=desc)
+  parser.add_argument('-d', '--database', default="results.sqlite", type=str,
+                      help='SQLite file of the results store (default="results.sqlite").')
+  parser.add_argument('-r', '--results_directory', default=None, type=str,
+                      help='Ingest new result files from this directory (default=None).')
+  parser.add_argument('--network', default=None, type=str,
+                      help='Only show results of this network (default=None).')
+  parser.add_argument('--station', default=None, type=str,
+                      help='Only show results of this station (default=None).')
+  parser.add_argument('--node', default=None, type=str,
+                      help='Only show results of this node (default=None).')
+  parser.add_argument('--start', default=None, type=str,
+                      help='Only show runs from this date on, as YYYY-MM-DD (default=None).')
+  parser.add_argument('--end', default=None, type=str,
+                      help='Only show runs before this date, as YYYY-MM-DD (default=None).')
+  args = parser.parse_args()
+  store = ResultsStore(args.database)
+  if args.results_directory is not None:
+    print('%d new result files ingested.' % store.ingest_directory(args.results_directory))
+  print('month    retrievability  wfcatalog  channels')
+  for month, ret, wfc, count in store.monthly(args.network, args.station, args.node,
+                                              timestamp(args.start), timestamp(args.end)):
+    print('%s  %13s  %9s  %8d' % (month, '%.1f %%' % (ret * 100) if ret is not None else '-',
+                                  '%.1f %%' % (wfc * 100) if wfc is not None else '-', count))
+  store.close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,42 @@
+"""Answers of the EIDA routing service, shared by both HTTP transports.
+
+   The routing service is asked in the POST format, so besides the data
+   centers it also tells which streams each of them serves and when.
+"""
+
+import fnmatch
+from obspy import UTCDateTime
+
+def parse_routes(text):
+  # Routing service answer in the POST format: blocks of a service URL
+  # followed by the streams it serves, as (net, sta, loc, cha, start, end)
+  routes = []
+  for block in text.strip().split('\n\n'):
+    lines = block.strip().splitlines()
+    if not lines:
+      continue
+    streams = []
+    for line in lines[1:]:
+      parts = line.split()
+      if len(parts) < 5:
+        continue
+      streams.append(tuple(parts[:4]) + (UTCDateTime(parts[4]),
+                     UTCDateTime(parts[5]) if len(parts) > 5 else None))
+    routes.append((lines[0].strip(), streams))
+  return routes
+
+def serves(stream, net, sta, cha, starttime):
+  snet, ssta, _, scha, start, end = stream
+  if not all(fnmatch.fnmatch(code, pattern) for code, pattern in
+             ((net, snet), (sta, ssta), (cha, scha))):
+    return False
+  return starttime is None or (start <= starttime and (end is None or starttime < end))
+
+def route_url(routes, net, sta=None, cha=None, starttime=None):
+  # The data center serving the channel at the given time, or the first
+  # one serving the network if no channel is given
+  for url, streams in routes:
+    if sta is None or streams is None or any(serves(stream, net, sta, cha, starttime)
+                                             for stream in streams):
+      return url
+  return None
@@ -0,0 +1,111 @@
+"""Deterministic sharding of check_retrievability.py runs over several hosts.
+
+   Channels are assigned to shards by a hash of their codes, and every
+   channel draws its days and hours from its own seeded generator, so any
+   shard can be reproduced on its own. Each shard writes a manifest of its
+   channels next to its results, which the merge checks the results against.
+"""
+
+import sys
+import json
+import random
+import hashlib
+import argparse
+
+def parse_shard(shard):
+  # "i/N", with shards numbered from 1 to N
+  try:
+    index, count = map(int, shard.split('/'))
+  except ValueError:
+    raise argparse.ArgumentTypeError('shard must be given as i/N, e.g. 1/4')
+  if count < 1 or not 1 <= index <= count:
+    raise argparse.ArgumentTypeError('shard %s is not between 1/%d and %d/%d' % (shard, count, count, count))
+  return index, count
+
+def shard_of(net, sta, cha, count):
+  digest = hashlib.sha1(('%s.%s.%s' % (net, sta, cha)).encode('utf-8')).hexdigest()
+  return int(digest, 16) % count + 1
+
+def channel_random(seed, y, net, sta, cha):
+  # String seeds are hashed with SHA-512, independent of the Python hash seed
+  return random.Random('%s:%d:%s.%s.%s' % (seed, y, net, sta, cha))
+
+def manifest_filename(output_filename):
+  return output_filename + '.shard'
+
+def write_manifest(output_filename, shard, seed, channels):
+  index, count = shard
+  with open(manifest_filename(output_filename), 'w') as outfile:
+    json.dump({'shard': index, 'shards': count, 'seed': seed,
+               'channels': sorted(channels)}, outfile)
+
+def merge_shards(filenames):
+  # Returns the merged results and a list of the problems found
+  results = {}
+  problems = []
+  owner = {}
+  shards = {}
+  settings = set()
+  for filename in filenames:
+    with open(filename) as infile:
+      result = json.load(infile)
+    with open(manifest_filename(filename)) as infile:
+      manifest = json.load(infile)
+    settings.add((manifest['shards'], manifest['seed']))
+    if manifest['shard'] in shards:
+      problems.append('Shard %d is in both %s and %s' % (manifest['shard'], shards[manifest['shard']], filename))
+    shards[manifest['shard']] = filename
+    assigned = set()
+    for node, y, net, sta, cha in manifest['channels']:
+      key = (node, str(y), net, sta, cha)
+      assigned.add(key)
+      if shard_of(net, sta, cha, manifest['shards']) != manifest['shard']:
+        problems.append('%s %s %s.%s.%s does not belong to shard %d' % (key + (manifest['shard'],)))
+      if key in owner:
+        problems.append('%s %s %s.%s.%s is in both %s and %s' % (key + (owner[key], filename)))
+        continue
+      owner[key] = filename
+      try:
+        value = result[node][str(y)][net][sta][cha]
+      except KeyError:
+        problems.append('%s %s %s.%s.%s is missing from %s' % (key + (filename,)))
+        continue
+      results.setdefault(node, {}).setdefault(str(y), {}).setdefault(net, {}) \
+             .setdefault(sta, {})[cha] = value
+    for node, nodeval in result.items():
+      for y, yearval in nodeval.items():
+        for net, netval in yearval.items():
+          for sta, staval in netval.items():
+            for cha in staval:
+              if (node, y, net, sta, cha) not in assigned:
+                problems.append('%s %s %s.%s.%s in %s is not in its manifest' % (node, y, net, sta, cha, filename))
+  if len(settings) > 1:
+    problems.append('The shards were run with different shard counts or seeds: %s' % sorted(settings, key=str))
+  for count, _ in settings:
+    for index in range(1, count + 1):
+      if index not in shards:
+        problems.append('Shard %d/%d is missing' % (index, count))
+  return results, problems
+
+def main():
+  desc = 'Script to merge the results of sharded check_retrievability.py runs.'
+  parser = argparse.ArgumentParser(description=desc)
+  parser.add_argument('filenames', nargs='+',
+                      help='Result files of all shards, each with its ".shard" manifest next to it.')
+  parser.add_argument('-o', '--output_filename', default="results.json", type=str,
+                      help='Filename to write the merged results to (default="results.json").')
+  parser.add_argument('-f', '--force', action='store_true',
+                      help='Write the merged results even if channels are missing or duplicated.')
+  args = parser.parse_args()
+  results, problems = merge_shards(args.filenames)
+  for problem in problems:
+    print(problem)
+  if problems and not args.force:
+    print('*!!!* %d problems found, no results written. *!!!*' % len(problems))
+    sys.exit(1)
+  with open(args.output_filename, 'w') as output:
+    json.dump(results, output)
+  print('Merged %d shards into "%s".' % (len(args.filenames), args.output_filename))
+
+if __name__ == '__main__':
+  main()